@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import configparser
+import logging
+from datetime import datetime, timedelta
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    from pyftpdlib.log import config_logging
+except ImportError:
+    print("The benchmark needs pyftpdlib: pip install pyftpdlib")
+    sys.exit(1)
+
+import switch_ftp_sync
+
+
+ALBUM_ROOTS = {
+    'sysMMC': "Nintendo/Album",
+    'emuMMC': "emuMMC/RAW1/Nintendo/Album"
+}
+
+
+class BenchmarkCounters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.bytes_sent = 0
+
+    def add(self, commands=0, bytes_sent=0):
+        with self.lock:
+            self.commands += commands
+            self.bytes_sent += bytes_sent
+
+    def snapshot(self):
+        with self.lock:
+            return self.commands, self.bytes_sent
+
+
+counters = BenchmarkCounters()
+
+
+class BenchmarkDTPHandler(ThrottledDTPHandler):
+    def close(self):
+        counters.add(bytes_sent=self.tot_bytes_sent)
+        super().close()
+
+
+class BenchmarkFTPHandler(FTPHandler):
+    latency = 0
+    dtp_handler = BenchmarkDTPHandler
+
+    def pre_process_command(self, line, cmd, arg):
+        # Every control round trip pays the simulated Wi-Fi latency
+        counters.add(commands=1)
+        if self.latency:
+            time.sleep(self.latency)
+        return super().pre_process_command(line, cmd, arg)
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def populate_album(root, args):
+    # Spread captures evenly over `days` date folders
+    start = datetime(2024, 1, 1, 12, 0, 0)
+    captures = []
+    for i in range(args.images + args.videos):
+        taken = start + timedelta(days=i * args.days // max(1, args.images + args.videos), seconds=i)
+        extension = ".mp4" if i < args.videos else ".jpg"
+        size = args.video_kb * 1024 if extension == ".mp4" else args.image_kb * 1024
+        name = taken.strftime("%Y%m%d%H%M%S") + "00-" + "%032X" % random.getrandbits(128) + extension
+        captures.append((taken, name, os.urandom(size)))
+
+    # The emuMMC album holds the same captures, as after copying them between the two
+    sources = ['sysMMC', 'emuMMC'] if args.emummc else ['sysMMC']
+    for source in sources:
+        for taken, name, content in captures:
+            path = os.path.join(root, ALBUM_ROOTS[source], taken.strftime("%Y/%m/%d"), name)
+            write_file(path, content)
+
+
+def populate_file_tree(root, args):
+    # A tree of folders `depth` levels deep with files spread across them
+    for i in range(args.files):
+        parts = [f"dir{(i // (args.fanout ** level)) % args.fanout}" for level in range(args.depth)]
+        write_file(os.path.join(root, "switch", *parts, f"file{i}.bin"), os.urandom(args.file_kb * 1024))
+
+
+def start_server(root, args):
+    authorizer = DummyAuthorizer()
+    authorizer.add_user("root", "bench", root, perm="elradfmwMT")
+    BenchmarkFTPHandler.authorizer = authorizer
+    BenchmarkFTPHandler.latency = args.latency / 1000.0
+    BenchmarkDTPHandler.write_limit = args.bandwidth * 1024
+    config_logging(level=logging.WARNING)
+
+    server = ThreadedFTPServer(("127.0.0.1", 0), BenchmarkFTPHandler)
+    server.max_cons = 0
+    threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True).start()
+    return server
+
+
+def write_config(work_dir, port, args):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_string(switch_ftp_sync.DEFAULT_CONFIG)
+    config.set('FTP', 'server', "127.0.0.1")
+    config.set('FTP', 'port', str(port))
+    config.set('FTP', 'pass', "bench")
+    config.set('Screenshots', 'output_path', os.path.join(work_dir, "screenshots"))
+    config.set('File Sync', 'server_path_1', "/switch")
+    config.set('File Sync', 'output_path_1', os.path.join(work_dir, "files"))
+    config.set('File Sync', 'sync_files_1', "True")
+    config.set('Settings', 'download_workers', str(args.workers))
+    config.set('Settings', 'workers', str(args.workers))
+    config.set('Settings', 'max_sessions', str(max(args.workers, 1) + 1))
+    path = os.path.join(work_dir, "config.ini")
+    with open(path, 'w') as config_file:
+        config.write(config_file)
+    return path
+
+
+def measure(label, cycle):
+    commands, bytes_sent = counters.snapshot()
+    time_in = time.time()
+    cycle()
+    elapsed = time.time() - time_in
+    commands_after, bytes_after = counters.snapshot()
+    return {
+        'label': label,
+        'seconds': elapsed,
+        'commands': commands_after - commands,
+        'bytes': bytes_after - bytes_sent
+    }
+
+
+def run_benchmark(args):
+    server_root = tempfile.mkdtemp(prefix="switch_ftp_sync_server_")
+    work_dir = tempfile.mkdtemp(prefix="switch_ftp_sync_bench_")
+    try:
+        populate_album(server_root, args)
+        populate_file_tree(server_root, args)
+        server = start_server(server_root, args)
+        port = server.address[1]
+
+        switch_ftp_sync.load_config(write_config(work_dir, port, args))
+        switch_ftp_sync.NOTIFICATIONS = False
+        if not args.verbose:
+            switch_ftp_sync.log_message = lambda message: None
+
+        pool = switch_ftp_sync.get_ftp_pool()
+        file_path = switch_ftp_sync.file_sync_paths[0]
+        cycles = {
+            'screenshots': lambda: switch_ftp_sync.sync_screenshots(pool),
+            'files': lambda: switch_ftp_sync.sync_files(pool, file_path.server_path, file_path.output_path)
+        }
+
+        results = []
+        for name, cycle in cycles.items():
+            results.append(measure(f"{name} cold", cycle))
+            steady = [measure(f"{name} steady", cycle) for _ in range(args.cycles)]
+            results.append({
+                'label': f"{name} steady",
+                'seconds': sum(result['seconds'] for result in steady) / len(steady),
+                'commands': sum(result['commands'] for result in steady) // len(steady),
+                'bytes': sum(result['bytes'] for result in steady) // len(steady)
+            })
+
+        pool.close_all()
+        switch_ftp_sync.get_sync_index().close()
+        server.close_all()
+        return results
+    finally:
+        shutil.rmtree(server_root, ignore_errors=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        switch_ftp_sync.sync_index = None
+        switch_ftp_sync.ftp_pools.clear()
+
+
+def print_results(results, args):
+    print(f"\nworkers={args.workers} images={args.images} videos={args.videos} days={args.days} "
+          f"emummc={args.emummc} files={args.files} latency={args.latency}ms bandwidth={args.bandwidth or 'unlimited'}KB/s")
+    print(f"{'cycle':<20}{'seconds':>10}{'round trips':>14}{'bytes':>14}")
+    for result in results:
+        print(f"{result['label']:<20}{result['seconds']:>10.3f}{result['commands']:>14}{result['bytes']:>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Switch FTP Sync against a local FTP server with a synthetic album.")
+    parser.add_argument("--images", type=int, default=300, help="number of JPG captures")
+    parser.add_argument("--videos", type=int, default=5, help="number of MP4 captures")
+    parser.add_argument("--image-kb", type=int, default=300, help="size of each JPG in KB")
+    parser.add_argument("--video-kb", type=int, default=4096, help="size of each MP4 in KB")
+    parser.add_argument("--days", type=int, default=60, help="number of date folders the captures are spread over")
+    parser.add_argument("--emummc", action="store_true", help="also put a copy of the album under emuMMC")
+    parser.add_argument("--files", type=int, default=200, help="number of files in the File Sync tree")
+    parser.add_argument("--file-kb", type=int, default=16, help="size of each File Sync file in KB")
+    parser.add_argument("--depth", type=int, default=3, help="folder depth of the File Sync tree")
+    parser.add_argument("--fanout", type=int, default=4, help="subfolders per folder in the File Sync tree")
+    parser.add_argument("--latency", type=float, default=0, help="added latency per FTP command in ms")
+    parser.add_argument("--bandwidth", type=int, default=0, help="data channel limit in KB/s (0 = unlimited)")
+    parser.add_argument("--cycles", type=int, default=3, help="number of steady-state cycles to average")
+    parser.add_argument("--workers", default="1", help="comma separated download_workers values to compare, e.g. 1,4")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for capture names")
+    parser.add_argument("--verbose", action="store_true", help="keep the sync log output")
+    args = parser.parse_args()
+
+    for workers in [int(value) for value in args.workers.split(',')]:
+        random.seed(args.seed)
+        args.workers = workers
+        print_results(run_benchmark(args), args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,32 +3,32 @@ import ftplib
 import os
 import time
 import configparser
+import posixpath
+from collections import namedtuple
 from datetime import datetime
-from PyQt5 import QtWidgets, QtGui, QtCore
 import threading
-import webbrowser
 import shutil
-import tempfile
-import uuid
-import requests
-
-# Import win10toast for Windows notifications
-if sys.platform == 'win32':
-    from winotify import Notification, audio
-elif sys.platform == 'darwin':  # macOS specific imports
-    from Foundation import NSObject, NSUserNotification, NSUserNotificationCenter, NSUserNotificationDefaultSoundName
-
-    class NotificationDelegate(NSObject):
-        def userNotificationCenter_didActivateNotification_(self, center, notification):
-            userInfo = notification.userInfo()
-            log_message(f"Notification clicked. User info: {userInfo}")
-            if userInfo:
-                file_path = userInfo.get('file_path')
-                log_message(f"Attempting to open file path: {file_path}")
-                if file_path:
-                    os.system(f'open "{file_path}"')
-else:
-    from plyer import notification
+import hashlib
+import zlib
+import sqlite3
+import contextlib
+import queue
+import heapq
+import random
+import json
+import socket
+import ipaddress
+import re
+import fnmatch
+import argparse
+import signal
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+
+# GUI (PyQt5), HTTP (requests) and notification libraries are imported lazily,
+# so headless syncing never pays for them. SyncEngine imports asyncio itself, so
+# one-shot runs and the snapshot commands don't pay for it either.
 
 
 TITLE = "Switch FTP Sync"
@@ -42,18 +42,21 @@ if getattr(sys, 'frozen', False):
 else:
     script_dir = os.path.dirname(os.path.abspath(__file__))
 
-# Use the standard temporary directory for the platform
-temp_download_dir = os.path.join(tempfile.gettempdir(), "switch_ftp_sync")
-if os.path.exists(temp_download_dir):
-    shutil.rmtree(temp_download_dir)
+# Downloads are staged in this hidden folder inside each output path, so finishing
+# one is a rename on the same filesystem. Partial files are kept there between runs.
+STAGING_DIR_NAME = ".switch_ftp_sync"
 
 
 # Path to the config.ini file
 config_path = os.path.join(script_dir, 'config.ini')
 
-# Ensure the config.ini file exists, create a default one if not
-if not os.path.exists(config_path):
-    default_config = """[FTP]
+# Sync state index and stats files live next to config.ini
+index_path = os.path.join(os.path.dirname(config_path), 'sync_state.db')
+stats_path = os.path.join(os.path.dirname(config_path), 'sync_stats')
+snapshots_path = os.path.join(os.path.dirname(config_path), 'snapshots')
+
+# Written to config_path the first time the app runs
+DEFAULT_CONFIG = """[FTP]
 server = X.X.X.X
 port = 5000
 user = root
@@ -63,8 +66,18 @@ pass =
 dt_format = %Y-%m-%d_%H-%M-%S
 output_path = 
 sync_screenshots = True
+album_scan = True
+full_scan_interval = 86400
+source_folders = False
+post_process = 
+processed_path = 
+thumbnail_size = 320
+thumbnail_format = webp
 
 [File Sync]
+full_verify_interval = 600
+snapshot_keep = 0
+
 server_path_1 = 
 output_path_1 =
 sync_files_1 = False
@@ -87,108 +100,188 @@ sync_files_5 = False
 
 [Settings]
 check_rate = 15
+fast_check_rate = 3
+fast_window = 120
+max_backoff = 300
+jitter = 0.1
 auto_start = False
+max_sessions = 3
+workers = 3
+keepalive_interval = 30
+download_workers = 2
+preallocate = False
+fsync = none
+metrics_port = 0
+notification_interval = 5
+max_bandwidth = 0
+post_process_workers = 1
+discovery = False
+discovery_timeout = 1
+discovery_workers = 32
+discovery_banner = Hello!
 """
-    with open(config_path, 'w') as config_file:
-        config_file.write(default_config)
 
-# Read configuration from config.ini
 config = configparser.ConfigParser(interpolation=None)  # Disable interpolation
-config.read(config_path)
-
-# FTP server details
-SERVER = config.get('FTP', 'server').strip('"')
-PORT = config.getint('FTP', 'port')
-USER = config.get('FTP', 'user').strip('"')
-PASS = config.get('FTP', 'pass').strip('"')
-
-# Screenshots settings
-SCREENSHOTS_PATH = config.get('Screenshots', 'output_path').strip('"')
-DT_FORMAT = config.get('Screenshots', 'dt_format')
-SYNC_SCREENSHOTS = config.getboolean('Screenshots', 'sync_screenshots')
 
 # File Sync paths
+SyncPath = namedtuple('SyncPath', ['server_path', 'output_path', 'check_rate', 'snapshots', 'sync_filter', 'direction'])
+
 file_sync_paths = []
-for i in range(1, 6):
-    server_path = config.get('File Sync', f'server_path_{i}', fallback='').strip('"')
-    output_path = config.get('File Sync', f'output_path_{i}', fallback='').strip('"')
-    sync_files = config.getboolean('File Sync', f'sync_files_{i}', fallback=False)
-    if server_path and output_path and sync_files:
-        file_sync_paths.append((server_path, output_path))
 
-# Settings
-CHECK_RATE = int(config.get('Settings', 'check_rate'))
-AUTO_START = config.getboolean('Settings', 'auto_start')
+# A Switch and its sync jobs. The [FTP], [Screenshots] and [File Sync] sections describe the
+# first one, every [FTP <name>] section adds another with its own output paths.
+Console = namedtuple('Console', ['name', 'server', 'port', 'user', 'password', 'max_sessions',
+                                 'screenshots_path', 'sync_screenshots', 'check_rate', 'file_sync_paths'])
+
+consoles = []
+
+def get_console(name=""):
+    return next((console for console in consoles if console.name == name), None)
+
+def console_label(console, name):
+    # Stats and logs of other consoles carry their name
+    return f"{console.name}: {name}" if console.name else name
+
+def is_screenshot(local_file_path):
+    return any(console.screenshots_path and local_file_path.startswith(console.screenshots_path) for console in consoles)
 
 running = False
 stop_event = threading.Event()
 
+# Headless runs stay quiet unless notifications are asked for
+NOTIFICATIONS = True
+
 def log_message(message):
     print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
 
 # Explicitly keep a reference to the delegate to prevent garbage collection
 notification_delegate = None
-
-def notify_file(file_name, local_file_path="", type="new"):
-    global notification_delegate
-    is_screenshot = local_file_path.startswith(SCREENSHOTS_PATH)
+NotificationDelegate = None
+
+def get_notification_delegate_class():
+    # PyObjC classes can only be defined once per process
+    global NotificationDelegate
+    if NotificationDelegate is None:
+        from Foundation import NSObject
+
+        class NotificationDelegate(NSObject):
+            def userNotificationCenter_didActivateNotification_(self, center, notification):
+                userInfo = notification.userInfo()
+                log_message(f"Notification clicked. User info: {userInfo}")
+                if userInfo:
+                    file_path = userInfo.get('file_path')
+                    log_message(f"Attempting to open file path: {file_path}")
+                    if file_path:
+                        os.system(f'open "{file_path}"')
+    return NotificationDelegate
+
+def file_kind(file_name, local_file_path):
+    if not is_screenshot(local_file_path):
+        return "file"
     file_extension = os.path.splitext(file_name)[1].lower()
+    if file_extension == ".mp4":
+        return "video"
+    elif file_extension == ".jpg" or file_extension == ".bmp" or file_extension == ".png":
+        return "image"
+    return "file"
+
+def notification_message(file_name, local_file_path, type):
+    kind = file_kind(file_name, local_file_path)
+    if type == "new":
+        return f"New {kind} {file_name} has been added."
+    return f"{kind.capitalize()} {file_name} has been updated."
+
+def summary_message(pending):
+    # e.g. "42 new images, 3 new videos, 1 updated file synced."
+    counts = {}
+    for file_name, local_file_path, type in pending:
+        key = ("new" if type == "new" else "updated", file_kind(file_name, local_file_path))
+        counts[key] = counts.get(key, 0) + 1
+    parts = [f"{count} {state} {kind}{'s' if count != 1 else ''}" for (state, kind), count in counts.items()]
+    return ", ".join(parts) + " synced."
+
+def notification_open_path(pending):
+    if len(pending) == 1:
+        _, local_file_path, _ = pending[0]
+        if is_screenshot(local_file_path):
+            return local_file_path
+        return os.path.dirname(local_file_path)
+    folders = [os.path.dirname(local_file_path) for _, local_file_path, _ in pending]
+    try:
+        common = os.path.commonpath(folders)
+    except ValueError:  # different drives
+        return folders[-1]
+    # Screenshots and File Sync paths rarely share more than the drive root
+    return folders[-1] if os.path.dirname(common) == common else common
 
-    message = ""
+notification_queue = queue.Queue()
+notification_thread = None
+notification_lock = threading.Lock()
 
-    if type == "new":
-        if is_screenshot:
-            if file_extension == ".mp4":
-                message = f"New video {file_name} has been added."
-            elif file_extension == ".jpg" or file_extension == ".bmp" or file_extension == ".png":
-                message = f"New image {file_name} has been added."
-            else:
-                message = f"New file {file_name} has been added."
-        else:
-            message = f"New file {file_name} has been added."
-    else:
-        if is_screenshot:
-            if file_extension == ".mp4":
-                message = f"Video {file_name} has been updated."
-            elif file_extension == ".jpg" or file_extension == ".bmp" or file_extension == ".png":
-                message = f"Image {file_name} has been updated."
-            else:
-                message = f"File {file_name} has been updated."
+def notify_file(file_name, local_file_path="", type="new"):
+    # Notifications are shown by their own thread so downloads never wait on them
+    global notification_thread
+    if not NOTIFICATIONS:
+        return
+    with notification_lock:
+        if notification_thread is None:
+            notification_thread = threading.Thread(target=notification_worker, name="notifications", daemon=True)
+            notification_thread.start()
+    notification_queue.put((file_name, local_file_path, type))
+
+def notification_worker():
+    last_sent = 0
+    while True:
+        pending = [notification_queue.get()]
+        # Files synced before the next notification is allowed are shown as one summary
+        deadline = last_sent + NOTIFICATION_INTERVAL
+        while True:
+            try:
+                pending.append(notification_queue.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        if len(pending) == 1:
+            file_name, local_file_path, type = pending[0]
+            message = notification_message(file_name, local_file_path, type)
         else:
-            message = f"File {file_name} has been updated."
+            message = summary_message(pending)
+        show_notification(message, notification_open_path(pending))
+        last_sent = time.time()
 
+def show_notification(message, open_path):
+    global notification_delegate
     if sys.platform == 'darwin':  # macOS
+        from Foundation import NSUserNotification, NSUserNotificationCenter, NSUserNotificationDefaultSoundName
         notification = NSUserNotification.alloc().init()
         notification.setTitle_(TITLE)
         notification.setInformativeText_(message)
         notification.setSoundName_(NSUserNotificationDefaultSoundName)
-        if is_screenshot:
-            notification.setUserInfo_({'file_path': local_file_path})
-        else:
-            notification.setUserInfo_({'file_path': os.path.dirname(local_file_path)})
+        notification.setUserInfo_({'file_path': open_path})
 
         center = NSUserNotificationCenter.defaultUserNotificationCenter()
-        notification_delegate = NotificationDelegate.alloc().init()
-        center.setDelegate_(notification_delegate)
-        log_message("Delegate set for notification center")
+        if notification_delegate is None:
+            notification_delegate = get_notification_delegate_class().alloc().init()
+            center.setDelegate_(notification_delegate)
+            log_message("Delegate set for notification center")
         center.deliverNotification_(notification)
-        log_message(f"Notification sent for new file: {file_name} with path: {local_file_path}")
+        log_message(f"Notification sent: {message} with path: {open_path}")
     elif sys.platform == 'win32':  # Windows
         try:
+            from winotify import Notification, audio
             icon_path = os.path.join(script_dir, "icon.ico")
-            launch_path = local_file_path if is_screenshot else os.path.dirname(local_file_path)
             toast = Notification(app_id=TITLE,
                                  title=TITLE,
                                  msg=message,
                                  icon=icon_path)
             toast.set_audio(audio.Default, loop=False)
-            toast.add_actions(label="Open File", launch=launch_path)
+            toast.add_actions(label="Open File", launch=open_path)
             toast.show()
-            log_message(f"Notification sent for new file: {file_name}")
+            log_message(f"Notification sent: {message}")
         except Exception as e:
             log_message(f"Failed to send notification: {e}")
     else:
         try:
+            from plyer import notification
             notification.notify(
                 title=TITLE,
                 message=message,
@@ -196,75 +289,1305 @@ def notify_file(file_name, local_file_path="", type="new"):
                 app_icon=os.path.join(script_dir, "icon.png"),  # path to your app icon
                 timeout=10  # Notification will disappear after 10 seconds
             )
-            log_message(f"Notification sent for new file: {file_name}")
+            log_message(f"Notification sent: {message}")
         except Exception as e:
             log_message(f"Failed to send notification: {e}")
 
-def connect_ftp():
+# Number of finished cycles kept per sync path in the stats file
+STATS_HISTORY = 50
+
+METRIC_HELP = {
+    'round_trips': "FTP control commands sent",
+    'listings': "Remote directory listings",
+    'listing_seconds': "Time spent listing remote directories",
+    'bytes': "Bytes downloaded",
+    'download_seconds': "Time spent downloading files",
+    'files_checked': "Remote files compared against the local copy",
+    'files_skipped': "Remote files that were already up to date",
+    'files_downloaded': "Files downloaded",
+    'duplicates_skipped': "Album captures found in both emuMMC and sysMMC that were only downloaded once",
+    'dirs_pruned': "Remote folders not listed because their entry in the parent listing was unchanged",
+    'dirs_filtered': "Remote folders not listed because of exclude rules or max_depth",
+    'files_filtered': "Remote files skipped because of include/exclude rules or max_size",
+    'files_unchanged': "Changed files whose checksum matched the local copy, so they were not downloaded",
+    'size_mismatches': "Downloads that ended with a different size than the listing",
+    'files_uploaded': "Files uploaded by File Sync paths",
+    'bytes_uploaded': "Bytes uploaded",
+    'upload_seconds': "Time spent uploading files",
+    'upload_bytes_avoided': "Bytes of local files not uploaded because the console already had them",
+    'snapshot_files': "File versions added to the snapshot store",
+    'snapshot_bytes': "Compressed bytes of new chunks written to the snapshot store",
+    'time_to_local_seconds': "Time from finding a file on the console to having it in the output folder",
+    'connection_failures': "Failed FTP connection attempts",
+    'discoveries': "Network scans for a console that wasn't at its last known address",
+    'discovery_seconds': "Time spent scanning the network for consoles",
+    'cycles': "Finished sync cycles",
+    'cycle_seconds': "Time spent in sync cycles"
+}
+
+GAUGE_HELP = {
+    'transfer_queue_depth': "Downloads waiting for a transfer worker",
+    'post_process_queue_depth': "Post-processing stages waiting for a worker process"
+}
+
+STAGE_HELP = {
+    'runs': "Post-processing stages finished",
+    'failures': "Post-processing stages that failed",
+    'seconds': "Time spent in post-processing stages"
+}
+
+class SyncMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.context = threading.local()
+        self.current = {}  # path -> counters of the running cycle
+        self.totals = {}
+        self.history = {}
+        self.gauges = {}
+        self.stages = {}  # post-processing stage -> counters
+
+    def current_path(self):
+        return getattr(self.context, 'path', None)
+
+    def set_path(self, path):
+        self.context.path = path
+
+    def add(self, name, value=1):
+        path = self.current_path()
+        if path is None:
+            return
+        with self.lock:
+            counters = self.current.setdefault(path, {})
+            counters[name] = counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def add_stage(self, stage, seconds, failed=False):
+        with self.lock:
+            counters = self.stages.setdefault(stage, {'runs': 0, 'failures': 0, 'seconds': 0})
+            counters['runs'] += 1
+            counters['failures'] += int(failed)
+            counters['seconds'] += seconds
+
+    @contextlib.contextmanager
+    def cycle(self, path):
+        self.set_path(path)
+        with self.lock:
+            self.current[path] = {}
+        time_in = time.time()
+        try:
+            yield
+        finally:
+            self.add('cycle_seconds', time.time() - time_in)
+            self.add('cycles')
+            self.finish_cycle(path)
+            self.set_path(None)
+
+    def finish_cycle(self, path):
+        with self.lock:
+            counters = self.current.pop(path, {})
+            totals = self.totals.setdefault(path, {})
+            for name, value in counters.items():
+                totals[name] = totals.get(name, 0) + value
+            record = dict(counters, finished=time.time())
+            if counters.get('download_seconds'):
+                record['throughput'] = counters.get('bytes', 0) / counters['download_seconds']
+            if counters.get('files_downloaded'):
+                record['time_to_local'] = counters.get('time_to_local_seconds', 0) / counters['files_downloaded']
+            self.history.setdefault(path, deque(maxlen=STATS_HISTORY)).append(record)
+        self.write_files()
+
+    def to_json(self):
+        with self.lock:
+            return {
+                'updated': time.time(),
+                'gauges': dict(self.gauges),
+                'post_processing': {stage: dict(counters) for stage, counters in self.stages.items()},
+                'paths': {
+                    path: {
+                        'totals': dict(self.totals.get(path, {})),
+                        'last_cycle': history[-1] if history else None,
+                        'history': list(history)
+                    }
+                    for path, history in self.history.items()
+                }
+            }
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, help_text in METRIC_HELP.items():
+                metric = f"switch_ftp_sync_{name}_total"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} counter")
+                for path, totals in self.totals.items():
+                    label = path.replace('\\', '\\\\').replace('"', '\\"')
+                    lines.append(f'{metric}{{path="{label}"}} {totals.get(name, 0)}')
+            for name, help_text in GAUGE_HELP.items():
+                metric = f"switch_ftp_sync_{name}"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {self.gauges.get(name, 0)}")
+            for name, help_text in STAGE_HELP.items():
+                metric = f"switch_ftp_sync_post_process_{name}_total"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} counter")
+                for stage, counters in self.stages.items():
+                    lines.append(f'{metric}{{stage="{stage}"}} {counters[name]}')
+        return "\n".join(lines) + "\n"
+
+    def write_files(self):
+        # Write next to the final name and swap it in, so readers never see half a file
+        try:
+            for extension, content in (('.json', json.dumps(self.to_json(), indent=2)), ('.prom', self.to_prometheus())):
+                with open(stats_path + extension + '.tmp', 'w') as stats_file:
+                    stats_file.write(content)
+                os.replace(stats_path + extension + '.tmp', stats_path + extension)
+        except OSError as e:
+            log_message(f"Failed to write stats: {e}")
+
+    def summary(self):
+        with self.lock:
+            lines = []
+            for path, history in self.history.items():
+                last = history[-1]
+                lines.append(f"{path}: {last.get('cycle_seconds', 0):.1f}s, {last.get('round_trips', 0)} round trips, "
+                             f"{last.get('files_downloaded', 0)} new")
+            return "\n".join(lines)
+
+metrics = SyncMetrics()
+
+def start_metrics_server(port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = metrics.to_prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/stats':
+                body, content_type = json.dumps(metrics.to_json()), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.end_headers()
+            self.wfile.write(body.encode('utf-8'))
+
+        def log_message(self, format, *args):
+            pass
+
     try:
-        ftp = ftplib.FTP()
-        ftp.connect(SERVER, PORT, timeout=10)  # Set timeout for connection
-        ftp.login(USER, PASS)
+        server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    except OSError as e:
+        log_message(f"Failed to start metrics endpoint on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log_message(f"Metrics available at http://127.0.0.1:{port}/metrics")
+    return server
+
+class SyncFTP(ftplib.FTP):
+    def putcmd(self, line):
+        metrics.add('round_trips')
+        super().putcmd(line)
+
+# Where each console was last reached, by console name. With discovery enabled this follows the
+# Switch to a new address after a DHCP lease change and is kept in sync_state.db across restarts.
+console_addresses = {}
+console_address_lock = threading.Lock()
+discovery_locks = {}
+last_discovery = {}  # console name -> time of the last scan that found nothing
+
+# Don't scan the network again for a console that wasn't found this recently
+DISCOVERY_COOLDOWN = 30
+
+def console_address(console):
+    if not DISCOVERY:
+        return console.server
+    with console_address_lock:
+        if console.name not in console_addresses:
+            known = get_sync_index().get_meta(f"address:{console.name}")
+            # Only trust it while the configured server is the one it was found for
+            if known and known['server'] == console.server:
+                console_addresses[console.name] = known['address']
+        return console_addresses.get(console.name, console.server)
+
+def remember_address(console, address):
+    with console_address_lock:
+        console_addresses[console.name] = address
+    get_sync_index().set_meta(f"address:{console.name}", {'server': console.server, 'address': address})
+
+def probe_ftp(address, port, timeout):
+    # A TCP connect and the 220 greeting, without logging in
+    try:
+        with socket.create_connection((address, port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            banner = sock.recv(256).decode('latin-1')
+    except OSError:
+        return False
+    return banner.startswith('220') and (not DISCOVERY_BANNER or any(text.lower() in banner.lower() for text in DISCOVERY_BANNER))
+
+def discovery_candidates(console, known):
+    # Every host of the /24 this machine reaches the console through, starting at the last known address
+    # (it may only have been slow) and moving outwards. Addresses of the other consoles are left out.
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect((known, console.port))  # Only picks the route, nothing is sent
+            local = sock.getsockname()[0]
+        network = ipaddress.ip_network(f"{local}/24", strict=False)
+        last = int(ipaddress.ip_address(known)) if ipaddress.ip_address(known) in network else int(ipaddress.ip_address(local))
+    except (OSError, ValueError):
+        return []
+    taken = set(console_address(other) for other in consoles if other.name != console.name) | {local}
+    hosts = [str(host) for host in network.hosts() if str(host) not in taken]
+    return sorted(hosts, key=lambda host: abs(int(ipaddress.ip_address(host)) - last))
+
+# Files each sync job last saw on a console, to tell it apart from other Switches on the network
+IDENTITY_FILES = 4
+console_identities = {}
+
+def identity_sources(console):
+    return ["Screenshots"] + [sync_path.server_path for sync_path in console.file_sync_paths]
+
+def remember_identity(console, source, entries):
+    if not DISCOVERY:
+        return
+    paths = [entry.path for entry in sorted(entries, key=lambda entry: entry.name)[-IDENTITY_FILES:]]
+    key = sync_state_key("identity", console, source)
+    with console_address_lock:
+        if not paths or console_identities.get(key) == paths:
+            return
+        console_identities[key] = paths
+    get_sync_index().set_meta(key, paths)
+
+def console_identity(console):
+    paths = []
+    for source in identity_sources(console):
+        key = sync_state_key("identity", console, source)
+        with console_address_lock:
+            if key not in console_identities:
+                console_identities[key] = get_sync_index().get_meta(key) or []
+            paths.extend(console_identities[key])
+    return paths
+
+def confirm_console(console, address, paths):
+    # Logs in and looks for a file this console was last seen with
+    ftp = SyncFTP()
+    try:
+        ftp.connect(address, console.port, timeout=10)
+        ftp.login(console.user, console.password)
+        ftp.voidcmd('TYPE I')
+        for path in paths:
+            try:
+                ftp.size(path)
+                return True
+            except ftplib.error_perm:
+                continue
+        return False
+    except ftplib.all_errors:
+        return False
+    finally:
+        ftp.close()
+
+def discover_console(console, known):
+    # Probe the subnet for the console's port, a few hosts at a time. A host with the right greeting
+    # must also have a file this console was last seen with, so another Switch on the network isn't
+    # taken for it. Until files are known, the nearest match is used and more than one is warned about.
+    with console_address_lock:
+        lock = discovery_locks.setdefault(console.name, threading.Lock())
+    with lock:
+        # Another session may have found it while this one waited
+        address = console_address(console)
+        if address != known:
+            return address
+        if time.time() - last_discovery.get(console.name, 0) < DISCOVERY_COOLDOWN:
+            return None
+        time_in = time.time()
+        candidates = discovery_candidates(console, known)
+        identity = console_identity(console)
+        found = None
+        matches = []
+        with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS, thread_name_prefix="discovery") as executor:
+            probes = {executor.submit(probe_ftp, host, console.port, DISCOVERY_TIMEOUT): host for host in candidates}
+            for probe in as_completed(probes):
+                if not probe.result():
+                    continue
+                matches.append(probes[probe])
+                if identity and confirm_console(console, probes[probe], identity):
+                    found = probes[probe]
+                    break
+            for probe in probes:
+                probe.cancel()
+        name = console_label(console, "Switch")
+        if not identity and matches:
+            # Nearest to the last known address first, as the candidates are ordered
+            found = min(matches, key=candidates.index)
+            if len(matches) > 1:
+                log_message(f"Warning: {len(matches)} FTP servers on port {console.port} look like a Switch "
+                            f"({', '.join(sorted(matches, key=candidates.index))}), using {found} for {name}. "
+                            f"Set server to the right address if this is the wrong console.")
+        elapsed = time.time() - time_in
+        metrics.add('discoveries')
+        metrics.add('discovery_seconds', elapsed)
+        if found is None:
+            last_discovery[console.name] = time.time()
+            if matches:
+                log_message(f"{name} not found: {len(matches)} FTP servers answered on port {console.port}, "
+                            f"but none had the files it was last seen with ({elapsed:.1f}s)")
+            else:
+                log_message(f"{name} not found on port {console.port} after probing {len(candidates)} addresses in {elapsed:.1f}s")
+            return None
+        last_discovery.pop(console.name, None)
+        remember_address(console, found)
+        log_message(f"{name} found at {found} in {elapsed:.1f}s")
+        return found
+
+def connect_ftp(console):
+    address = console_address(console)
+    try:
+        ftp = SyncFTP()
+        try:
+            # With discovery, a Switch that moved is given up on quickly instead of after the full timeout
+            ftp.connect(address, console.port, timeout=DISCOVERY_TIMEOUT if DISCOVERY else 10)  # Set timeout for connection
+        except OSError:
+            if not DISCOVERY:
+                raise
+            address = discover_console(console, address)
+            if address is None:
+                raise
+            ftp.connect(address, console.port, timeout=10)
+        ftp.timeout = 10
+        ftp.sock.settimeout(10)
+        ftp.login(console.user, console.password)
         # Switch to passive mode
         ftp.set_pasv(True)
-        log_message(f"FTP Connection to {SERVER} successful.")
+        log_message(f"FTP Connection to {address} successful.")
         return ftp
     except Exception as e:
+        metrics.add('connection_failures')
         log_message(f"Error connecting to FTP server: {e}")
         return None
 
+# Listing facts for a single remote directory entry
+RemoteEntry = namedtuple('RemoteEntry', ['path', 'name', 'type', 'size', 'modify'])
+
+LIST_MONTHS = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12
+}
+
+def parse_ftp_time(value):
+    # MLSD and MDTM both use YYYYMMDDHHMMSS with optional fractional seconds
+    try:
+        return datetime.strptime(value.split('.')[0], "%Y%m%d%H%M%S")
+    except (ValueError, AttributeError):
+        return None
+
+def parse_list_line(path, line):
+    # Unix style: -rw-r--r-- 1 owner group 12345 Jan 01 12:00 name
+    parts = line.split(None, 8)
+    if len(parts) < 9 or parts[0][0] not in '-d':
+        return None
+    name = parts[8]
+    if name in ('.', '..'):
+        return None
+    entry_type = 'dir' if parts[0][0] == 'd' else 'file'
+    size = int(parts[4]) if parts[4].isdigit() else None
+    modify = None
+    month = LIST_MONTHS.get(parts[5][:3].lower())
+    if month and parts[6].isdigit():
+        try:
+            if ':' in parts[7]:
+                # Recent entries omit the year, so pick the one that isn't in the future
+                hour, minute = (int(x) for x in parts[7].split(':'))
+                now = datetime.now()
+                modify = datetime(now.year, month, int(parts[6]), hour, minute)
+                if modify > now:
+                    modify = modify.replace(year=now.year - 1)
+            else:
+                modify = datetime(int(parts[7]), month, int(parts[6]))
+        except ValueError:
+            modify = None
+    return RemoteEntry(posixpath.join(path, name), name, entry_type, size, modify)
+
+# Idle sessions older than this get a NOOP before being handed out again
+HEALTH_CHECK_AGE = 5
+
+class FTPPool:
+    def __init__(self, console, max_sessions, keepalive_interval):
+        self.console = console
+        self.max_sessions = max(1, max_sessions)
+        self.keepalive_interval = keepalive_interval
+        self.slots = threading.Condition()
+        self.in_use = 0
+        self.lock = threading.Lock()
+        self.idle = []  # (ftp, last_used)
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+
+    def acquire(self):
+        self.take_slot()
+        ftp = None
+        while ftp is None:
+            with self.lock:
+                if not self.idle:
+                    break
+                ftp, last_used = self.idle.pop()
+            if time.time() - last_used > HEALTH_CHECK_AGE and not self.is_alive(ftp):
+                self.close(ftp)
+                ftp = None
+                with self.lock:
+                    self.reconnects += 1
+        if ftp is not None:
+            with self.lock:
+                self.hits += 1
+            return ftp
+
+        with self.lock:
+            self.misses += 1
+        ftp = connect_ftp(self.console)
+        if ftp is None:
+            self.give_slot()
+        return ftp
+
+    def release(self, ftp, broken=False):
+        with self.lock:
+            keep = not broken and ftp.sock is not None and len(self.idle) < self.max_sessions
+            if keep:
+                self.idle.append((ftp, time.time()))
+        if not keep:
+            self.close(ftp)
+        self.give_slot()
+
+    def take_slot(self, blocking=True):
+        with self.slots:
+            while self.in_use >= self.max_sessions:
+                if not blocking:
+                    return False
+                self.slots.wait()
+            self.in_use += 1
+            return True
+
+    def has_free_slot(self):
+        with self.slots:
+            return self.in_use < self.max_sessions
+
+    def give_slot(self):
+        with self.slots:
+            self.in_use -= 1
+            self.slots.notify()
+
+    def resize(self, max_sessions, keepalive_interval):
+        # Sessions in use beyond a lower limit finish their work and are closed when idle
+        with self.slots:
+            self.max_sessions = max(1, max_sessions)
+            self.slots.notify_all()
+        self.keepalive_interval = keepalive_interval
+        with self.lock:
+            extra, self.idle = self.idle[self.max_sessions:], self.idle[:self.max_sessions]
+        for ftp, _ in extra:
+            self.close(ftp)
+
+    @contextlib.contextmanager
+    def session(self):
+        ftp = self.acquire()
+        if ftp is None:
+            yield None
+            return
+        broken = False
+        try:
+            yield ftp
+        except (EOFError, OSError, ftplib.error_temp):
+            broken = True
+            raise
+        finally:
+            self.release(ftp, broken)
+
+    def is_alive(self, ftp):
+        if ftp.sock is None:
+            return False
+        try:
+            ftp.voidcmd('NOOP')
+            return True
+        except ftplib.all_errors:
+            return False
+
+    def close(self, ftp):
+        if ftp.sock is None:
+            return
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for ftp, _ in idle:
+            self.close(ftp)
+
+    def ping_idle(self):
+        # Ping idle sessions so sys-ftpd doesn't drop them between cycles.
+        # Only borrow a slot that nobody else is waiting on.
+        if not self.take_slot(blocking=False):
+            return
+        try:
+            with self.lock:
+                stale = [item for item in self.idle if time.time() - item[1] >= self.keepalive_interval]
+                self.idle = [item for item in self.idle if item not in stale]
+            for ftp, _ in stale:
+                if self.is_alive(ftp):
+                    with self.lock:
+                        self.idle.append((ftp, time.time()))
+                else:
+                    self.close(ftp)
+        finally:
+            self.give_slot()
+
+    def stats(self):
+        with self.lock:
+            return f"{console_label(self.console, 'FTP pool')}: {self.hits} hits, {self.misses} misses, {self.reconnects} reconnects, {len(self.idle)}/{self.max_sessions} idle"
+
+# One pool per console, by console name
+ftp_pools = {}
+ftp_pool_lock = threading.Lock()
+
+def get_ftp_pool(name=""):
+    with ftp_pool_lock:
+        if name not in ftp_pools:
+            console = get_console(name)
+            ftp_pools[name] = FTPPool(console, console.max_sessions, KEEPALIVE_INTERVAL)
+        return ftp_pools[name]
+
+def close_ftp_pools():
+    with ftp_pool_lock:
+        pools = list(ftp_pools.values())
+    for pool in pools:
+        pool.close_all()
+
+def list_directory(ftp, path):
+    time_in = time.time()
+    try:
+        return list_directory_entries(ftp, path)
+    finally:
+        metrics.add('listings')
+        metrics.add('listing_seconds', time.time() - time_in)
+
+def list_directory_entries(ftp, path):
+    entries = []
+    mlsd_failed = False
+    if getattr(ftp, 'mlsd_supported', True):
+        try:
+            for name, facts in ftp.mlsd(path):
+                entry_type = facts.get('type', '').lower()
+                if entry_type not in ('file', 'dir') or name in ('.', '..'):
+                    continue
+                size = facts.get('size')
+                entries.append(RemoteEntry(
+                    posixpath.join(path, name),
+                    name,
+                    entry_type,
+                    int(size) if size and size.isdigit() else None,
+                    parse_ftp_time(facts.get('modify'))
+                ))
+            return entries
+        except ftplib.error_perm as e:
+            if str(e)[:3] not in ('500', '501', '502', '504'):
+                raise
+            # Some servers answer 501 for a missing folder too, so only give up on MLSD
+            # once LIST works where it didn't
+            entries = []
+            mlsd_failed = True
+
+    lines = []
+    ftp.cwd(path)
+    ftp.retrlines('LIST -la', lines.append)
+    for line in lines:
+        entry = parse_list_line(path, line)
+        if entry:
+            entries.append(entry)
+    if mlsd_failed:
+        # Server doesn't understand MLSD, remember that and stick to LIST
+        ftp.mlsd_supported = False
+    return entries
+
 def list_files(ftp, path):
     file_list = []
     try:
-        ftp.cwd(path)
-        files = ftp.nlst()
-        for file in files:
-            full_path = os.path.join(path, file)
-            try:
-                ftp.cwd(full_path)
-                file_list.extend(list_files(ftp, full_path))
-                ftp.cwd('..')
-            except ftplib.error_perm:
-                file_list.append(full_path)
+        entries = list_directory(ftp, path)
     except ftplib.all_errors as e:
         log_message(f"Error listing files in {path}: {e}")
+        return file_list
+    for entry in entries:
+        if entry.type == 'dir':
+            file_list.extend(list_files(ftp, entry.path))
+        else:
+            file_list.append(entry)
     return file_list
 
 
+class SyncIndex:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # WAL keeps the index consistent if the app is killed mid-cycle
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            remote_path TEXT NOT NULL,
+            local_path TEXT NOT NULL,
+            size INTEGER,
+            remote_mtime REAL,
+            status TEXT NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (remote_path, local_path))""")
+        # Journal of in-flight downloads, so partial files can be resumed after a restart
+        self.db.execute("""CREATE TABLE IF NOT EXISTS transfers (
+            part_path TEXT PRIMARY KEY,
+            remote_path TEXT NOT NULL,
+            local_path TEXT NOT NULL,
+            size INTEGER,
+            remote_mtime REAL,
+            offset INTEGER,
+            started REAL NOT NULL)""")
+        # Listing fingerprints of File Sync folders whose files were all current when last walked
+        self.db.execute("""CREATE TABLE IF NOT EXISTS dirs (
+            remote_path TEXT NOT NULL,
+            local_path TEXT NOT NULL,
+            listing TEXT NOT NULL,
+            entry TEXT NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (remote_path, local_path))""")
+        # Local versions of files last uploaded by File Sync paths
+        self.db.execute("""CREATE TABLE IF NOT EXISTS uploads (
+            local_path TEXT NOT NULL,
+            remote_path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            local_mtime REAL NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (local_path, remote_path))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL)""")
+        # Post-processing stages per synced capture, pending ones are picked up again after a restart
+        self.db.execute("""CREATE TABLE IF NOT EXISTS processed (
+            local_path TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            source_name TEXT NOT NULL,
+            mtime REAL NOT NULL,
+            status TEXT NOT NULL,
+            seconds REAL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (local_path, stage))""")
+        self.db.commit()
+        self.clean_transfers()
+
+        # Keep every row in memory so lookups never touch the disk
+        self.entries = {}
+        for remote_path, local_path, size, remote_mtime, status in self.db.execute(
+                "SELECT remote_path, local_path, size, remote_mtime, status FROM files"):
+            self.entries[(remote_path, local_path)] = (size, remote_mtime, status)
+        self.dirs = {}
+        for remote_path, local_path, listing, entry in self.db.execute(
+                "SELECT remote_path, local_path, listing, entry FROM dirs"):
+            self.dirs[(remote_path, local_path)] = (listing, entry)
+        self.uploads = {}
+        for local_path, remote_path, size, local_mtime in self.db.execute(
+                "SELECT local_path, remote_path, size, local_mtime FROM uploads"):
+            self.uploads[(local_path, remote_path)] = (size, local_mtime)
+
+    def is_current(self, entry, local_path):
+        with self.lock:
+            row = self.entries.get((entry.path, local_path))
+        if not row or row[2] != 'done':
+            return False
+        size, remote_mtime, _ = row
+        if entry.size is not None and entry.size != size:
+            return False
+        if entry.modify is not None and entry.modify.timestamp() != remote_mtime:
+            return False
+        return True
+
+    def mark(self, entry, local_path, status, remote_timestamp=None):
+        remote_timestamp = remote_timestamp or entry.modify
+        remote_mtime = remote_timestamp.timestamp() if remote_timestamp else None
+        with self.lock:
+            self.entries[(entry.path, local_path)] = (entry.size, remote_mtime, status)
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (entry.path, local_path, entry.size, remote_mtime, status, time.time())
+            )
+            self.db.commit()
+
+    def get_dir(self, remote_path, local_path):
+        with self.lock:
+            return self.dirs.get((remote_path, local_path))
+
+    def set_dir(self, remote_path, local_path, listing, entry):
+        with self.lock:
+            if self.dirs.get((remote_path, local_path)) == (listing, entry):
+                return
+            self.dirs[(remote_path, local_path)] = (listing, entry)
+            self.db.execute(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)",
+                (remote_path, local_path, listing, entry, time.time())
+            )
+            self.db.commit()
+
+    def is_uploaded(self, local_path, remote_path, size, local_mtime):
+        with self.lock:
+            return self.uploads.get((local_path, remote_path)) == (size, local_mtime)
+
+    def mark_uploaded(self, local_path, remote_path, size, local_mtime):
+        with self.lock:
+            self.uploads[(local_path, remote_path)] = (size, local_mtime)
+            self.db.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)",
+                (local_path, remote_path, size, local_mtime, time.time())
+            )
+            self.db.commit()
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+            self.db.commit()
+
+    def queue_processing(self, local_path, source_name, mtime, stages):
+        # Only stages that haven't run on this version of the file are queued
+        with self.lock:
+            done = set(stage for (stage,) in self.db.execute(
+                "SELECT stage FROM processed WHERE local_path = ? AND mtime = ? AND status != 'pending'",
+                (local_path, mtime)
+            ))
+            queued = [stage for stage in stages if stage not in done]
+            for stage in queued:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, 'pending', NULL, ?)",
+                    (local_path, stage, source_name, mtime, time.time())
+                )
+            self.db.commit()
+        return queued
+
+    def pending_processing(self, stages, limit):
+        marks = ", ".join("?" * len(stages))
+        with self.lock:
+            return self.db.execute(
+                f"SELECT local_path, stage, source_name, mtime FROM processed "
+                f"WHERE status = 'pending' AND stage IN ({marks}) ORDER BY updated LIMIT ?",
+                (*stages, limit)
+            ).fetchall()
+
+    def count_pending_processing(self, stages):
+        marks = ", ".join("?" * len(stages))
+        with self.lock:
+            return self.db.execute(
+                f"SELECT COUNT(*) FROM processed WHERE status = 'pending' AND stage IN ({marks})", stages
+            ).fetchone()[0]
+
+    def finish_processing(self, local_path, stage, mtime, status, seconds=None):
+        # A newer download of the same file is queued again under its own mtime
+        with self.lock:
+            self.db.execute(
+                "UPDATE processed SET status = ?, seconds = ?, updated = ? WHERE local_path = ? AND stage = ? AND mtime = ?",
+                (status, seconds, time.time(), local_path, stage, mtime)
+            )
+            self.db.commit()
+
+    def resume_offset(self, part_path):
+        # Preallocated partials are full size on disk, so their progress lives in the journal
+        if not os.path.exists(part_path):
+            return 0
+        with self.lock:
+            row = self.db.execute("SELECT offset FROM transfers WHERE part_path = ?", (part_path,)).fetchone()
+        if row and row[0] is not None:
+            return row[0]
+        return os.path.getsize(part_path)
+
+    def start_transfer(self, part_path, remote_path, local_path, size, remote_timestamp, offset=None):
+        remote_mtime = remote_timestamp.timestamp() if remote_timestamp else None
+        with self.lock:
+            # A different partial for the same file belongs to an older version of it
+            stale = self.db.execute(
+                "SELECT part_path FROM transfers WHERE remote_path = ? AND local_path = ? AND part_path != ?",
+                (remote_path, local_path, part_path)
+            ).fetchall()
+            for (stale_path,) in stale:
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+            self.db.execute("DELETE FROM transfers WHERE remote_path = ? AND local_path = ?", (remote_path, local_path))
+            self.db.execute(
+                "INSERT INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (part_path, remote_path, local_path, size, remote_mtime, offset, time.time())
+            )
+            self.db.commit()
+
+    def update_transfer(self, part_path, offset):
+        with self.lock:
+            self.db.execute("UPDATE transfers SET offset = ? WHERE part_path = ?", (offset, part_path))
+            self.db.commit()
+
+    def finish_transfer(self, part_path):
+        with self.lock:
+            self.db.execute("DELETE FROM transfers WHERE part_path = ?", (part_path,))
+            self.db.commit()
+
+    def clean_transfers(self):
+        # Forget journal entries whose partial file is gone and delete partial files nobody owns
+        with self.lock:
+            journal = []
+            for (part_path,) in self.db.execute("SELECT part_path FROM transfers").fetchall():
+                if os.path.exists(part_path):
+                    journal.append(part_path)
+                else:
+                    self.db.execute("DELETE FROM transfers WHERE part_path = ?", (part_path,))
+            self.db.commit()
+            for staging_dir in set(os.path.dirname(part_path) for part_path in journal):
+                for name in os.listdir(staging_dir):
+                    part_path = os.path.join(staging_dir, name)
+                    if name.endswith('.part') and part_path not in journal:
+                        os.remove(part_path)
+            if journal:
+                log_message(f"{len(journal)} interrupted downloads can be resumed")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+sync_index = None
+sync_index_lock = threading.Lock()
+
+def get_sync_index():
+    global sync_index
+    with sync_index_lock:
+        if sync_index is None:
+            sync_index = SyncIndex(index_path)
+        return sync_index
+
+
+class LocalSnapshot:
+    # One scandir pass over an output folder, taken the first time a cycle needs it
+    # and kept up to date from that cycle's downloads
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.files = None  # path -> (mtime, size)
+        self.dirs = set()
+
+    def scan(self):
+        files = {}
+        dirs = set()
+        pending = [self.root]
+        while pending:
+            path = pending.pop()
+            try:
+                with os.scandir(path) as it:
+                    dirs.add(path)
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name == STAGING_DIR_NAME:
+                                dirs.add(entry.path)
+                            else:
+                                pending.append(entry.path)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            files[entry.path] = (stat.st_mtime, stat.st_size)
+            except OSError:
+                continue
+        self.files = files
+        self.dirs = dirs
+
+    def stat(self, path):
+        with self.lock:
+            if self.files is None:
+                self.scan()
+            return self.files.get(path)
+
+    def has_dir(self, path):
+        with self.lock:
+            return self.files is not None and path in self.dirs
+
+    def add_dir(self, path):
+        with self.lock:
+            self.dirs.add(path)
+
+    def record(self, path, mtime, size):
+        with self.lock:
+            if self.files is not None:
+                self.files[path] = (mtime, size)
+            self.dirs.add(os.path.dirname(path))
+
+
+# Save data rarely changes more than a few blocks at a time, so versions are stored as chunks of this size
+SNAPSHOT_CHUNK_BYTES = 64 * 1024
+
+# Held while chunks are added, manifests written or chunks swept. The chunk store is shared by every
+# path, so a sweep must not run while another path holds chunks that aren't in a manifest yet.
+snapshot_store_lock = threading.RLock()
+
+class SnapshotStore:
+    # Content-addressed, zlib-compressed chunks shared by every snapshot-enabled path,
+    # plus one JSON manifest per cycle that changed something
+    def __init__(self, root, server_path, output_path):
+        self.root = root
+        self.server_path = server_path
+        self.output_path = output_path
+        key = hashlib.sha1(f"{server_path}|{output_path}".encode('utf-8')).hexdigest()[:16]
+        self.manifests_dir = os.path.join(root, "manifests", key)
+        self.lock = snapshot_store_lock
+        self.changed = {}  # relative path -> file record, written by the next commit()
+
+    def chunk_path(self, chunk_id):
+        return os.path.join(self.root, "chunks", chunk_id[:2], chunk_id)
+
+    def put_chunk(self, chunk_id, block):
+        # Returns the bytes added to the store, 0 for a chunk it already has
+        path = self.chunk_path(chunk_id)
+        if os.path.exists(path):
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = zlib.compress(block, 6)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        return len(data)
+
+    def add(self, local_path):
+        chunks = []
+        digest = hashlib.sha256()
+        stored = 0
+        # A chunk found already stored must stay until this record is in changed, where prune() sees it
+        with self.lock:
+            with open(local_path, 'rb') as f:
+                for block in iter(lambda: f.read(SNAPSHOT_CHUNK_BYTES), b''):
+                    digest.update(block)
+                    chunk_id = hashlib.sha256(block).hexdigest()
+                    stored += self.put_chunk(chunk_id, block)
+                    chunks.append(chunk_id)
+            stat = os.stat(local_path)
+            record = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest.hexdigest(), 'chunks': chunks}
+            self.changed[os.path.relpath(local_path, self.output_path).replace(os.sep, '/')] = record
+        metrics.add('snapshot_files')
+        metrics.add('snapshot_bytes', stored)
+
+    def add_tree(self):
+        # The first snapshot of a path starts from everything already synced
+        for folder, dir_names, file_names in os.walk(self.output_path):
+            dir_names[:] = [name for name in dir_names if name != STAGING_DIR_NAME]
+            for name in file_names:
+                local_path = os.path.join(folder, name)
+                with self.lock:
+                    known = os.path.relpath(local_path, self.output_path).replace(os.sep, '/') in self.changed
+                if not known:
+                    try:
+                        self.add(local_path)
+                    except OSError as e:
+                        log_message(f"Failed to snapshot {local_path}: {e}")
+
+    def snapshots(self):
+        try:
+            return sorted(name[:-5] for name in os.listdir(self.manifests_dir) if name.endswith('.json'))
+        except FileNotFoundError:
+            return []
+
+    def load(self, snapshot_id):
+        with open(os.path.join(self.manifests_dir, f"{snapshot_id}.json")) as f:
+            return json.load(f)
+
+    def commit(self):
+        with self.lock:
+            changed, self.changed = self.changed, {}
+            if not changed:
+                return None
+            # A manifest lists the whole tree, so any one of them can be restored on its own
+            existing = self.snapshots()
+            files = self.load(existing[-1])['files'] if existing else {}
+            files.update(changed)
+            snapshot_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+            manifest = {'server_path': self.server_path, 'output_path': self.output_path, 'created': time.time(), 'files': files}
+            os.makedirs(self.manifests_dir, exist_ok=True)
+            path = os.path.join(self.manifests_dir, f"{snapshot_id}.json")
+            with open(path + '.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.replace(path + '.tmp', path)
+            log_message(f"Snapshot {snapshot_id} of {self.server_path}: {len(changed)} changed files")
+            if SNAPSHOT_KEEP > 0 and len(existing) + 1 > SNAPSHOT_KEEP:
+                self.prune(SNAPSHOT_KEEP)
+            return snapshot_id
+
+    def prune(self, keep):
+        with self.lock:
+            for snapshot_id in self.snapshots()[:-keep]:
+                os.remove(os.path.join(self.manifests_dir, f"{snapshot_id}.json"))
+            # Chunks are shared between paths, so only drop the ones no manifest anywhere uses
+            used = set()
+            manifests_root = os.path.join(self.root, "manifests")
+            for folder, _, file_names in os.walk(manifests_root):
+                for name in file_names:
+                    if name.endswith('.json'):
+                        with open(os.path.join(folder, name)) as f:
+                            for record in json.load(f)['files'].values():
+                                used.update(record['chunks'])
+            removed = 0
+            # Chunks of files any path added since its last commit aren't in a manifest yet
+            with snapshot_stores_lock:
+                stores = set(snapshot_stores.values()) | {self}
+            for store in stores:
+                for record in store.changed.values():
+                    used.update(record['chunks'])
+            for folder, _, file_names in os.walk(os.path.join(self.root, "chunks")):
+                for name in file_names:
+                    if name not in used and not name.endswith('.tmp'):
+                        os.remove(os.path.join(folder, name))
+                        removed += 1
+            if removed:
+                log_message(f"Removed {removed} chunks no longer used by any snapshot")
+
+    def restore(self, snapshot_id, target):
+        manifest = self.load(snapshot_id)
+        restored = skipped = 0
+        for relative_path, record in manifest['files'].items():
+            local_path = os.path.join(target, *relative_path.split('/'))
+            # Files that already match the snapshot are left alone
+            if os.path.exists(local_path) and os.path.getsize(local_path) == record['size'] \
+                    and local_checksum(local_path, 'SHA-256') == record['sha256']:
+                skipped += 1
+                continue
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with open(local_path + '.tmp', 'wb') as f:
+                for chunk_id in record['chunks']:
+                    with open(self.chunk_path(chunk_id), 'rb') as chunk:
+                        f.write(zlib.decompress(chunk.read()))
+            os.utime(local_path + '.tmp', (record['mtime'], record['mtime']))
+            os.replace(local_path + '.tmp', local_path)
+            restored += 1
+        return restored, skipped
+
+snapshot_stores = {}
+snapshot_stores_lock = threading.Lock()
+
+def get_snapshot_store(server_path, output_path):
+    with snapshot_stores_lock:
+        key = (server_path, output_path)
+        if key not in snapshot_stores:
+            snapshot_stores[key] = SnapshotStore(snapshots_path, server_path, output_path)
+        return snapshot_stores[key]
+
+
+# Local equivalents of the algorithms HASH, XCRC and XMD5 report
+CHECKSUM_ALGORITHMS = {'CRC32': 'crc32', 'MD5': 'md5', 'SHA-1': 'sha1', 'SHA-256': 'sha256', 'SHA-512': 'sha512'}
+
+def has_feature(ftp, command):
+    # Ask FEAT once per session which extensions the server offers
+    if not hasattr(ftp, 'features'):
+        try:
+            ftp.features = [line.strip().upper() for line in ftp.sendcmd('FEAT').splitlines()[1:-1]]
+        except ftplib.all_errors:
+            ftp.features = []
+    return any(feature.split(' ')[0] == command for feature in ftp.features)
+
+def checksum_command(ftp):
+    # The checksum command the server offers, if any
+    if not hasattr(ftp, 'checksum_command'):
+        ftp.checksum_command = next((command for command in ('HASH', 'XCRC', 'XMD5') if has_feature(ftp, command)), None)
+    return ftp.checksum_command
+
+def remote_checksum(ftp, remote_file):
+    command = checksum_command(ftp)
+    if command is None:
+        return None
+    try:
+        response = ftp.sendcmd(f"{command} {remote_file}")
+    except ftplib.all_errors as e:
+        log_message(f"{command} failed for {remote_file}: {e}")
+        return None
+    parts = response[4:].split()
+    if command == 'HASH':
+        # 213 SHA-256 0-1234 <hash> <path>
+        if len(parts) < 3 or parts[0].upper() not in CHECKSUM_ALGORITHMS:
+            return None
+        return parts[0].upper(), parts[2].lower()
+    if not parts:
+        return None
+    # Some servers echo the path before the checksum
+    return 'CRC32' if command == 'XCRC' else 'MD5', parts[-1].lower()
+
+def local_checksum(local_file, algorithm):
+    name = CHECKSUM_ALGORITHMS[algorithm]
+    crc = 0
+    digest = None if name == 'crc32' else hashlib.new(name)
+    with open(local_file, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            if digest:
+                digest.update(block)
+            else:
+                crc = zlib.crc32(block, crc)
+    return digest.hexdigest() if digest else f"{crc:08x}"
 
-def download_file(ftp, remote_file, local_file):
-    
-    # Ensure the switch_ftp_sync subdirectory exists
-    os.makedirs(temp_download_dir, exist_ok=True)
+def same_content(ftp, remote_file, local_file):
+    checksum = remote_checksum(ftp, remote_file)
+    if checksum is None:
+        return False
+    algorithm, remote_value = checksum
+    try:
+        local_value = local_checksum(local_file, algorithm)
+    except OSError:
+        return False
+    if algorithm == 'CRC32':
+        # CRCs come back with or without leading zeros
+        try:
+            return int(remote_value, 16) == int(local_value, 16)
+        except ValueError:
+            return False
+    return remote_value == local_value
+
+# Journal progress of preallocated downloads every this many bytes
+CHECKPOINT_BYTES = 8 * 1024 * 1024
+
+def make_staging_dir(staging_dir):
+    if os.path.isdir(staging_dir):
+        return
+    os.makedirs(staging_dir, exist_ok=True)
+    if sys.platform == 'win32':
+        import ctypes
+        ctypes.windll.kernel32.SetFileAttributesW(staging_dir, 0x02)  # FILE_ATTRIBUTE_HIDDEN
+
+def partial_file_path(staging_dir, remote_file, size, remote_timestamp):
+    # The same remote version always maps to the same partial file
+    key = f"{remote_file}|{size}|{remote_timestamp.timestamp() if remote_timestamp else ''}"
+    return os.path.join(staging_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + ".part")
+
+def preallocate_file(f, size):
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    f.truncate(size)
+
+def fsync_directory(path):
+    if sys.platform == 'win32':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class TransferStopped(Exception):
+    # Raised from a transfer callback to abort a download when syncing stops
+    pass
+
+def download_file(ftp, remote_file, local_file, size=None, remote_timestamp=None, staging_dir=None, snapshot=None):
+    if staging_dir is None:
+        staging_dir = os.path.join(os.path.dirname(local_file), STAGING_DIR_NAME)
+    index = get_sync_index()
+    time_in = time.time()
 
     try:
-        # Generate a unique temporary file path within the switch_ftp_sync subdirectory
-        unique_filename = f"{uuid.uuid4()}.tmp"
-        temp_file_path = os.path.join(temp_download_dir, unique_filename)
+        if snapshot is None or not snapshot.has_dir(staging_dir):
+            make_staging_dir(staging_dir)
+            if snapshot:
+                snapshot.add_dir(staging_dir)
+        temp_file_path = partial_file_path(staging_dir, remote_file, size, remote_timestamp)
         
         # Ensure the local directory exists
         local_dir = os.path.dirname(local_file)
-        os.makedirs(local_dir, exist_ok=True)
-
-        # Download the file to the temporary path
-        with open(temp_file_path, 'wb') as f:
-            ftp.retrbinary(f'RETR {remote_file}', f.write)
+        if snapshot is None or not snapshot.has_dir(local_dir):
+            os.makedirs(local_dir, exist_ok=True)
+
+        offset = index.resume_offset(temp_file_path)
+        if (size is not None and offset > size) or not getattr(ftp, 'rest_supported', True):
+            offset = 0
+        tracked = bool(PREALLOCATE and size)
+        index.start_transfer(temp_file_path, remote_file, local_file, size, remote_timestamp, offset if tracked else None)
+
+        with open(temp_file_path, 'r+b' if offset else 'wb') as f:
+            if not offset and tracked:
+                preallocate_file(f, size)
+            position = [offset, offset]  # bytes written, last journaled
+
+            def write_block(block):
+                if stop_event.is_set():
+                    # Give up on the rest, the partial file is resumed on the next start
+                    raise TransferStopped()
+                if bandwidth_limit:
+                    bandwidth_limit.consume(len(block))
+                f.write(block)
+                position[0] += len(block)
+                metrics.add('bytes', len(block))
+                if tracked and position[0] - position[1] >= CHECKPOINT_BYTES:
+                    f.flush()
+                    index.update_transfer(temp_file_path, position[0])
+                    position[1] = position[0]
 
-        # Move the file from the temporary path to the final local path
-        shutil.move(temp_file_path, local_file)
-        # log_message(f"Downloaded {remote_file} to {local_file} via temporary path {temp_file_path}")
+            try:
+                if size is None or offset < size:
+                    if offset:
+                        log_message(f"Resuming {remote_file} from byte {offset}")
+                    f.seek(offset)
+                    try:
+                        ftp.retrbinary(f'RETR {remote_file}', write_block, rest=offset or None)
+                    except (ftplib.error_perm, ftplib.error_reply) as e:
+                        if not offset or not str(e).startswith(('500', '502', '504')):
+                            raise
+                        # Server rejected REST, start the file over
+                        ftp.rest_supported = False
+                        f.seek(0)
+                        position[0] = position[1] = 0
+                        ftp.retrbinary(f'RETR {remote_file}', write_block)
+                # Drop any preallocated space the server didn't fill
+                f.truncate(position[0])
+                if size is not None and position[0] != size:
+                    # Keep the partial file, the next cycle resumes or restarts it
+                    metrics.add('size_mismatches')
+                    log_message(f"Size mismatch downloading {remote_file}: expected {size} bytes, got {position[0]}")
+                    return False
+                if FSYNC in ('file', 'full'):
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                if tracked:
+                    f.flush()
+                    index.update_transfer(temp_file_path, position[0])
+
+        # Staging shares the output filesystem, so this is a rename rather than a copy
+        try:
+            os.replace(temp_file_path, local_file)
+        except OSError:
+            shutil.move(temp_file_path, local_file)
+        if FSYNC == 'full':
+            fsync_directory(local_dir)
+        index.finish_transfer(temp_file_path)
+        metrics.add('files_downloaded')
+        return True
+    except TransferStopped:
+        log_message(f"Stopped downloading {remote_file}")
+        # The server is still sending the rest, so the session can't be used again
+        ftp.close()
+        return False
     except ftplib.all_errors as e:
+        # The partial file stays behind and is resumed on the next attempt
         log_message(f"Error downloading file {remote_file} to {local_file}: {e}")
+        return False
     finally:
-        # No need to explicitly remove the temporary directory since we are using a shared temp directory
-        pass
+        metrics.add('download_seconds', time.time() - time_in)
 
 
 def get_file_timestamp(ftp, file_path):
     try:
         response = ftp.sendcmd(f"MDTM {file_path}")[4:].strip()
-        if response.isdigit():
-            return datetime.strptime(response, "%Y%m%d%H%M%S")
+        if response.split('.')[0].isdigit():
+            return parse_ftp_time(response)
         else:
             log_message(f"Unexpected MDTM response for file {file_path}: {response}")
             return None
@@ -275,7 +1598,7 @@ def get_file_timestamp(ftp, file_path):
     #    return None
 
 
-def format_filename(file_name, dt_format):
+def capture_time(file_name):
     base_name, extension = os.path.splitext(file_name)
     
     # Check if the file extension is .bmp and set the format accordingly
@@ -285,87 +1608,1054 @@ def format_filename(file_name, dt_format):
         
     try:
         timestamp_str = base_name.split('-')[0]
-        timestamp_dt = datetime.strptime(timestamp_str, default_format)
-        formatted_str = timestamp_dt.strftime(dt_format)
-        return formatted_str
+        return datetime.strptime(timestamp_str, default_format)
     except ValueError:
-        return base_name
+        return None
+
+def format_filename(file_name, dt_format):
+    timestamp_dt = capture_time(file_name)
+    if timestamp_dt is None:
+        return os.path.splitext(file_name)[0]
+    return timestamp_dt.strftime(dt_format)
+
+def album_day(root, directory):
+    # Album captures live in YYYY/MM/DD folders below the album root
+    parts = posixpath.relpath(directory, root).split('/')
+    if [len(part) for part in parts] == [4, 2, 2] and all(part.isdigit() for part in parts):
+        return directory
+    return None
+
+def newest_child_dir(entries, digits):
+    names = [entry.name for entry in entries if entry.type == 'dir' and len(entry.name) == digits and entry.name.isdigit()]
+    return max(names) if names else None
+
+def sync_state_key(kind, console, *paths):
+    # Incremental scan state belongs to one console and one output folder, so two consoles on the same
+    # host or a changed output_path start from a full scan instead of inheriting someone else's progress
+    return ":".join((kind, console.name, console.server, str(console.port), *paths))
+
+def list_album_files(ftp, root, console):
+    index = get_sync_index()
+    key = sync_state_key("album", console, console.screenshots_path, root)
+    state = index.get_meta(key)
+
+    if state is None or time.time() - state['full_scan'] > FULL_SCAN_INTERVAL:
+        # Index the whole album, only remembering it as complete if nothing failed
+        files = []
+        def walk(path):
+            for entry in list_directory(ftp, path):
+                if entry.type == 'dir':
+                    walk(entry.path)
+                else:
+                    files.append(entry)
+        try:
+            walk(root)
+        except ftplib.all_errors as e:
+            log_message(f"Error listing files in {root}: {e}")
+            return files
+        days = [album_day(root, posixpath.dirname(entry.path)) for entry in files]
+        days = [day for day in days if day]
+        index.set_meta(key, {'full_scan': time.time(), 'newest_day': max(days) if days else None})
+        return files
+
+    # New captures only land in the newest day, so follow the newest year and month down to it
+    try:
+        newest_day = root
+        for digits in (4, 2, 2):
+            child = newest_child_dir(list_directory(ftp, newest_day), digits)
+            if child is None:
+                newest_day = None
+                break
+            newest_day = posixpath.join(newest_day, child)
+    except ftplib.all_errors as e:
+        log_message(f"Error listing files in {root}: {e}")
+        return []
+
+    # Also recheck the previous newest day in case captures landed there before a new day started
+    files = []
+    for day in sorted(set(day for day in (state['newest_day'], newest_day) if day)):
+        try:
+            files.extend(entry for entry in list_directory(ftp, day) if entry.type == 'file')
+        except ftplib.all_errors as e:
+            log_message(f"Error listing files in {day}: {e}")
+    if newest_day and newest_day != state['newest_day']:
+        state['newest_day'] = newest_day
+        index.set_meta(key, state)
+    return files
+
+class PollScheduler:
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+        self.failures = 0
+        self.fast_until = 0
+
+    def next_delay(self, elapsed, changes):
+        # changes is None when the Switch couldn't be reached this cycle
+        now = time.time()
+        if changes is None:
+            self.failures += 1
+            delay = min(self.interval * 2 ** self.failures, MAX_BACKOFF)
+            log_message(f"{self.name} unreachable {self.failures} time(s) in a row, retrying in {delay:.0f}s")
+        else:
+            self.failures = 0
+            if changes:
+                # Captures tend to come in bursts, so keep checking quickly for a while
+                self.fast_until = now + FAST_WINDOW
+            interval = min(FAST_CHECK_RATE, self.interval) if now < self.fast_until else self.interval
+            delay = max(0, interval - elapsed)
+        # Spread the sync threads out so they don't all hit the console at once
+        return delay * (1 + random.uniform(-JITTER, JITTER))
+
+
+# A file discovered as needing a download, finished by whichever transfer worker picks it up
+DownloadJob = namedtuple('DownloadJob', ['entry', 'local_path', 'display_name', 'remote_timestamp', 'is_update', 'staging_dir', 'snapshot', 'discovered', 'store'])
+
+def make_download_job(ftp, index, entry, remote_timestamp, local_file_path, display_name, snapshot, store=None):
+    # remote_timestamp is None when neither the listing nor MDTM had one
+    local = snapshot.stat(local_file_path)
+    if local is not None:
+        local_mtime, local_size = local
+        size_changed = entry.size is not None and entry.size != local_size
+        newer = remote_timestamp is not None and remote_timestamp > datetime.fromtimestamp(local_mtime)
+        if not size_changed and not newer:
+            # Already up to date locally, just remember that
+            metrics.add('files_skipped')
+            index.mark(entry, local_file_path, 'done', remote_timestamp)
+            return None
+        if not size_changed and same_content(ftp, entry.path, local_file_path):
+            # Touched on the console but identical, only take over the new time
+            os.utime(local_file_path, (remote_timestamp.timestamp(), remote_timestamp.timestamp()))
+            snapshot.record(local_file_path, remote_timestamp.timestamp(), local_size)
+            metrics.add('files_unchanged')
+            index.mark(entry, local_file_path, 'done', remote_timestamp)
+            return None
+    staging_dir = os.path.join(snapshot.root, STAGING_DIR_NAME)
+    return DownloadJob(entry, local_file_path, display_name, remote_timestamp, local is not None, staging_dir, snapshot, time.time(), store)
+
+def run_download_job(ftp, index, job):
+    if not download_file(ftp, job.entry.path, job.local_path, job.entry.size, job.remote_timestamp, job.staging_dir, job.snapshot):
+        index.mark(job.entry, job.local_path, 'failed', job.remote_timestamp)
+        return False
+    if job.remote_timestamp:
+        os.utime(job.local_path, (job.remote_timestamp.timestamp(), job.remote_timestamp.timestamp()))
+        job.snapshot.record(job.local_path, job.remote_timestamp.timestamp(), job.entry.size)
+    else:
+        job.snapshot.record(job.local_path, time.time(), job.entry.size)
+    log_message(f"Downloaded: {job.entry.path}")
+    metrics.add('time_to_local_seconds', time.time() - job.discovered)
+    if job.store:
+        try:
+            job.store.add(job.local_path)
+        except OSError as e:
+            log_message(f"Failed to snapshot {job.local_path}: {e}")
+    processor = get_post_processor()
+    if processor and is_screenshot(job.local_path):
+        processor.submit(job.local_path, job.entry.name)
+    if job.is_update:
+        notify_file(job.display_name, job.local_path, "update")
+    else:
+        notify_file(job.display_name, job.local_path, "new")
+    index.mark(job.entry, job.local_path, 'done', job.remote_timestamp)
+    return True
+
+def transfer_files(pool, jobs, path_priority=0):
+    if not jobs:
+        return
+    transfer_scheduler.run(pool, jobs, path_priority)
+
+# Files above this size wait behind smaller ones, so a new screenshot doesn't queue behind videos
+LARGE_FILE_BYTES = 8 * 1024 * 1024
+
+def job_priority(job, path_priority):
+    # Screenshots before File Sync paths, small files before large ones, newest first
+    size = job.entry.size or 0
+    newest = -job.remote_timestamp.timestamp() if job.remote_timestamp else 0
+    return (path_priority, size > LARGE_FILE_BYTES, newest, size)
+
+class TransferBatch:
+    # The jobs one sync cycle handed to the scheduler, so the cycle can wait for them
+    def __init__(self, pool, count):
+        self.pool = pool
+        self.remaining = count
+        self.metrics_path = metrics.current_path()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def finish(self, count=1):
+        with self.lock:
+            self.remaining -= count
+            if self.remaining <= 0:
+                self.done.set()
+
+class TransferScheduler:
+    # Downloads of every sync path, in one priority queue per console. Workers take turns
+    # between consoles, so a bulk sync on one Switch doesn't hold up the others.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}  # pool -> heap of queued downloads
+        self.turns = deque()  # pools with downloads queued, next to be served first
+        self.sequence = 0
+        self.workers = 0
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def run(self, pool, jobs, path_priority):
+        batch = TransferBatch(pool, len(jobs))
+        with self.lock:
+            if pool not in self.queues:
+                self.queues[pool] = []
+                self.turns.append(pool)
+            for job in jobs:
+                heapq.heappush(self.queues[pool], (job_priority(job, path_priority), self.sequence, job, batch))
+                self.sequence += 1
+            queued = self.queued()
+            metrics.set_gauge('transfer_queue_depth', queued)
+            # Each console gets up to its own session cap, all of them together up to the shared threads
+            wanted = min(sum(min(DOWNLOAD_WORKERS, queued_pool.max_sessions) for queued_pool in self.queues), WORKERS)
+            new_workers = min(max(1, wanted) - self.workers, queued)
+            self.workers += max(0, new_workers)
+            workers = self.workers
+        if workers > 1:
+            log_message(f"Downloading {queued} files with {workers} workers")
+        for started in range(max(0, new_workers)):
+            try:
+                submit_transfer(self.worker)
+            except RuntimeError:
+                # Workers that never started mustn't be counted, or later batches would wait for them
+                with self.lock:
+                    self.workers -= new_workers - started
+                raise
+        batch.done.wait()
+
+    def next_job(self):
+        with self.lock:
+            if stop_event.is_set():
+                for pool in list(self.queues):
+                    self.drop(pool)
+            if not self.turns:
+                self.workers -= 1
+                return None
+            # The first console in line that has a free session, so workers don't wait on a busy one
+            pool = next((pool for pool in self.turns if pool.has_free_slot()), self.turns[0])
+            self.turns.remove(pool)
+            queue = self.queues[pool]
+            _, _, job, batch = heapq.heappop(queue)
+            if queue:
+                self.turns.append(pool)
+            else:
+                del self.queues[pool]
+            metrics.set_gauge('transfer_queue_depth', self.queued())
+            return job, batch
+
+    def drop(self, pool):
+        # Called with the lock held
+        for item in self.queues.pop(pool, []):
+            item[3].finish()
+        if pool in self.turns:
+            self.turns.remove(pool)
+        metrics.set_gauge('transfer_queue_depth', self.queued())
+
+    def worker(self):
+        # next_job() gives up the worker's place when the queue is empty, anything else that ends it must too
+        # or run() would count a worker that is gone and never start another one
+        finished = False
+        try:
+            index = get_sync_index()
+            while True:
+                item = self.next_job()
+                if item is None:
+                    finished = True
+                    return
+                job, batch = item
+                metrics.set_path(batch.metrics_path)
+                try:
+                    with batch.pool.session() as ftp:
+                        if ftp is None:
+                            # Console unreachable, leave the rest of its files for the next cycle
+                            with self.lock:
+                                self.drop(batch.pool)
+                        elif not run_download_job(ftp, index, job) and not batch.pool.is_alive(ftp):
+                            # Session died mid-transfer, hand it back closed
+                            ftp.close()
+                except Exception as e:
+                    # One bad file mustn't take the worker with it
+                    log_message(f"Error downloading {job.entry.path}: {e}")
+                finally:
+                    batch.finish()
+                    metrics.set_path(None)
+        finally:
+            if not finished:
+                with self.lock:
+                    self.workers -= 1
+
+transfer_scheduler = TransferScheduler()
+
+class TokenBucket:
+    # Caps the combined download rate of all transfers
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going negative reserves bandwidth ahead, so waiting threads take turns
+            self.tokens -= amount
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_time:
+            time.sleep(wait_time)
+
+bandwidth_limit = None
+
+# Transfer workers of every sync path share these threads
+transfer_executor = None
+transfer_executor_lock = threading.Lock()
+
+def submit_transfer(function, *args):
+    # Under the lock, so a reload can't shut the executor down between looking it up and submitting
+    global transfer_executor
+    with transfer_executor_lock:
+        if transfer_executor is None:
+            transfer_executor = ThreadPoolExecutor(max_workers=max(1, WORKERS), thread_name_prefix="transfer")
+        return transfer_executor.submit(function, *args)
+
+# Post-processing of synced captures. Stages run in worker processes and write into
+# PROCESSED_PATH, so CPU work never holds up a sync cycle and the synced files stay untouched.
+PostProcessStage = namedtuple('PostProcessStage', ['function', 'extensions'])
+
+POST_PROCESS_STAGES = {}
+
+def post_process_stage(name, extensions):
+    def register(function):
+        POST_PROCESS_STAGES[name] = PostProcessStage(function, extensions)
+        return function
+    return register
+
+def processed_file_path(options, folder, local_path, extension=None):
+    name = os.path.basename(local_path)
+    if extension:
+        name = os.path.splitext(name)[0] + extension
+    path = os.path.join(options['output_root'], folder, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+def finish_processed_file(temp_path, path, source_name):
+    # Outputs carry the capture time from the album file name
+    captured = capture_time(source_name)
+    if captured:
+        os.utime(temp_path, (captured.timestamp(), captured.timestamp()))
+    os.replace(temp_path, path)
+
+@post_process_stage('thumbnail', ('.jpg', '.png', '.bmp'))
+def make_thumbnail(local_path, source_name, options):
+    from PIL import Image
+    thumbnail_format = options['thumbnail_format']
+    path = processed_file_path(options, 'thumbnails', local_path, f".{thumbnail_format}")
+    with Image.open(local_path) as image:
+        image.thumbnail((options['thumbnail_size'], options['thumbnail_size']))
+        image.convert('RGB').save(path + '.tmp', format=thumbnail_format.upper())
+    finish_processed_file(path + '.tmp', path, source_name)
+
+@post_process_stage('remux', ('.mp4',))
+def remux_video(local_path, source_name, options):
+    # Copy the streams into a new container with the index up front, so videos start playing right away
+    import subprocess
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg not found")
+    path = processed_file_path(options, 'videos', local_path)
+    temp_path = path + '.tmp.mp4'
+    subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-i', local_path, '-c', 'copy', '-movflags', '+faststart', temp_path],
+                   check=True, capture_output=True)
+    finish_processed_file(temp_path, path, source_name)
+
+@post_process_stage('date_tag', ('.jpg',))
+def tag_capture_date(local_path, source_name, options):
+    captured = capture_time(source_name)
+    if captured is None:
+        return
+    import piexif
+    path = processed_file_path(options, 'tagged', local_path)
+    shutil.copyfile(local_path, path + '.tmp')
+    exif = piexif.load(path + '.tmp')
+    exif['Exif'][piexif.ExifIFD.DateTimeOriginal] = captured.strftime("%Y:%m:%d %H:%M:%S").encode('ascii')
+    exif.pop('thumbnail', None)
+    piexif.insert(piexif.dump(exif), path + '.tmp')
+    finish_processed_file(path + '.tmp', path, source_name)
+
+def run_post_process_stage(stage, local_path, source_name, options):
+    # Runs in a worker process
+    time_in = time.time()
+    POST_PROCESS_STAGES[stage].function(local_path, source_name, options)
+    return time.time() - time_in
+
+class PostProcessor:
+    # Feeds pending stages from the sync index to a process pool, at most
+    # max_in_flight at a time, so a bulk sync queues up on disk instead of in memory
+    def __init__(self, stages, workers, options):
+        self.stages = stages
+        self.workers = max(1, workers)
+        self.max_in_flight = self.workers * 2
+        self.options = options
+        self.executor = None
+        self.in_flight = set()  # (local_path, stage)
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        # Start with whatever the last run left pending
+        self.wake.set()
+        threading.Thread(target=self.feed, name="post-processing", daemon=True).start()
+
+    def submit(self, local_path, source_name):
+        extension = os.path.splitext(local_path)[1].lower()
+        stages = [stage for stage in self.stages if extension in POST_PROCESS_STAGES[stage].extensions]
+        if not stages:
+            return
+        try:
+            mtime = os.path.getmtime(local_path)
+        except OSError:
+            return
+        if get_sync_index().queue_processing(local_path, source_name, mtime, stages):
+            self.wake.set()
+
+    def feed(self):
+        index = get_sync_index()
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            if self.closed:
+                return
+            with self.lock:
+                busy = set(self.in_flight)
+            free = self.max_in_flight - len(busy)
+            metrics.set_gauge('post_process_queue_depth', index.count_pending_processing(self.stages))
+            if free <= 0:
+                continue
+            rows = index.pending_processing(self.stages, free + len(busy))
+            for local_path, stage, source_name, mtime in [row for row in rows if row[:2] not in busy][:free]:
+                self.start(index, local_path, stage, source_name, mtime)
+
+    def start(self, index, local_path, stage, source_name, mtime):
+        if self.executor is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # Spawned workers don't inherit the sync threads' locks and sockets
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        with self.lock:
+            self.in_flight.add((local_path, stage))
+        try:
+            future = self.executor.submit(run_post_process_stage, stage, local_path, source_name, self.options)
+        except RuntimeError as e:
+            # Pool broken by a crashed worker, the stage stays pending for a new one
+            log_message(f"Post-processing unavailable: {e}")
+            self.executor = None
+            with self.lock:
+                self.in_flight.discard((local_path, stage))
+            self.wake.set()
+            return
+        future.add_done_callback(lambda future: self.finish(index, local_path, stage, mtime, future))
+
+    def finish(self, index, local_path, stage, mtime, future):
+        if future.cancelled():
+            # Shutting down, leave it pending for the next run
+            status, seconds = 'pending', None
+        elif future.exception() is not None:
+            status, seconds = 'failed', None
+            log_message(f"Post-processing {stage} failed for {local_path}: {future.exception()}")
+            metrics.add_stage(stage, 0, failed=True)
+        else:
+            status, seconds = 'done', future.result()
+            metrics.add_stage(stage, seconds)
+        if not self.closed or status != 'pending':
+            index.finish_processing(local_path, stage, mtime, status, seconds)
+        with self.lock:
+            self.in_flight.discard((local_path, stage))
+        self.wake.set()
+
+    def drain(self):
+        # Wait for everything queued so far, used before a single headless cycle exits
+        index = get_sync_index()
+        while not self.closed and (index.count_pending_processing(self.stages) or self.in_flight):
+            time.sleep(0.5)
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+post_processor = None
+post_processor_lock = threading.Lock()
+
+def get_post_processor():
+    global post_processor
+    if not POST_PROCESS:
+        return None
+    with post_processor_lock:
+        if post_processor is None:
+            post_processor = PostProcessor(POST_PROCESS, POST_PROCESS_WORKERS, {
+                'output_root': PROCESSED_PATH,
+                'thumbnail_size': THUMBNAIL_SIZE,
+                'thumbnail_format': THUMBNAIL_FORMAT
+            })
+        return post_processor
+
+def close_post_processor():
+    global post_processor
+    with post_processor_lock:
+        if post_processor:
+            post_processor.close()
+            post_processor = None
+
+# Album roots on the console, with the folder each one gets when source_folders is on
+SCREENSHOT_SOURCES = [("emuMMC", "/emuMMC/RAW1/Nintendo/Album/"), ("sysMMC", "/Nintendo/Album/")]
+
+def same_capture(ftp, first, second):
+    # Captures keep their name when copied between emuMMC and sysMMC
+    if first.size is None or first.size != second.size:
+        return False
+    if checksum_command(ftp) is None:
+        return True
+    first_checksum = remote_checksum(ftp, first.path)
+    return first_checksum is None or first_checksum == remote_checksum(ftp, second.path)
+
+def link_source_copy(screenshots_path, local_file_path, source, name):
+    # A hardlink costs no transfer and no disk space
+    link_path = os.path.join(screenshots_path, source, name)
+    if os.path.exists(link_path):
+        return
+    try:
+        os.makedirs(os.path.dirname(link_path), exist_ok=True)
+        os.link(local_file_path, link_path)
+    except OSError as e:
+        log_message(f"Failed to link {local_file_path} into {source} folder: {e}")
 
-def sync_screenshots(ftp):
+def sync_screenshots(pool):
+    with metrics.cycle(console_label(pool.console, "Screenshots")):
+        return sync_screenshots_cycle(pool)
+
+def sync_screenshots_cycle(pool):
     time_in = time.time()
-    screenshot_paths = ["/emuMMC/RAW1/Nintendo/Album/", "/Nintendo/Album/"]
-    for path in screenshot_paths:
-        log_message(f"Syncing {path} to {SCREENSHOTS_PATH}")
-        current_files = list_files(ftp, path)
-        for file in current_files:
-            file_name = os.path.basename(file)
-            formatted_name = format_filename(file_name, DT_FORMAT) + os.path.splitext(file_name)[1]
-            local_file_path = os.path.join(SCREENSHOTS_PATH, formatted_name)
-            remote_timestamp = get_file_timestamp(ftp, file)
-            if remote_timestamp:
-                local_timestamp = remote_timestamp
-                if (os.path.exists(local_file_path)):
-                    local_timestamp = datetime.fromtimestamp(os.path.getmtime(local_file_path))
-                if not os.path.exists(local_file_path) or remote_timestamp > local_timestamp:
-                    download_file(ftp, file, local_file_path)
-                    os.utime(local_file_path, (remote_timestamp.timestamp(), remote_timestamp.timestamp()))
-                    log_message(f"Downloaded: {file}")
-                    if remote_timestamp > local_timestamp:
-                        notify_file(formatted_name, local_file_path, "update")
-                    else:
-                        notify_file(formatted_name, local_file_path, "new")
+    index = get_sync_index()
+    screenshots_path = pool.console.screenshots_path
+    snapshot = LocalSnapshot(screenshots_path)
+    jobs = []
+    duplicates = []  # (entry, local_file_path, entry being downloaded for it)
+    links = []  # (local_file_path, source, name in the source folder)
+    # The first cycle with source_folders on lists the whole album to link captures already synced
+    backfill_key = sync_state_key("source_folders", pool.console, screenshots_path)
+    backfill = SOURCE_FOLDERS and not index.get_meta(backfill_key)
+    with pool.session() as ftp:
+        if ftp is None:
+            return None
+        captures = {}  # formatted name -> [(source, entry)]
+        for source, path in SCREENSHOT_SOURCES:
+            log_message(f"Syncing {path} to {screenshots_path}")
+            if ALBUM_SCAN and not backfill:
+                current_files = list_album_files(ftp, path, pool.console)
+            else:
+                current_files = list_files(ftp, path)
+            for entry in current_files:
+                formatted_name = format_filename(entry.name, DT_FORMAT) + os.path.splitext(entry.name)[1]
+                captures.setdefault(formatted_name, []).append((source, entry))
+        remember_identity(pool.console, "Screenshots", [entry for copies in captures.values() for _, entry in copies])
+
+        for formatted_name, copies in captures.items():
+            _, first = copies[0]
+            for source, entry in copies:
+                local_file_path = os.path.join(screenshots_path, formatted_name)
+                # Same name with different content keeps both, the later source gets a suffix
+                stem, extension = os.path.splitext(formatted_name)
+                renamed_path = os.path.join(screenshots_path, f"{stem}-{source}{extension}")
+                metrics.add('files_checked')
+                if index.is_current(entry, local_file_path) or (entry is not first and index.is_current(entry, renamed_path)):
+                    metrics.add('files_skipped')
+                    if backfill:
+                        links.append((renamed_path if index.is_current(entry, renamed_path) else local_file_path, source, formatted_name))
+                    continue
+                if entry is not first:
+                    if same_capture(ftp, first, entry):
+                        metrics.add('duplicates_skipped')
+                        duplicates.append((entry, local_file_path, first))
+                        links.append((local_file_path, source, formatted_name))
+                        continue
+                    local_file_path = renamed_path
+                links.append((local_file_path, source, formatted_name))
+                remote_timestamp = entry.modify or get_file_timestamp(ftp, entry.path)
+                if not remote_timestamp:
+                    log_message(f"Failed to get timestamp for {entry.path}, comparing by size only")
+                job = make_download_job(ftp, index, entry, remote_timestamp, local_file_path, os.path.basename(local_file_path), snapshot)
+                if job:
+                    jobs.append(job)
+    transfer_files(pool, jobs, 0)
+
+    # A duplicate is done as soon as its twin is
+    for entry, local_file_path, first in duplicates:
+        if index.is_current(first, local_file_path):
+            index.mark(entry, local_file_path, 'done')
+    if SOURCE_FOLDERS:
+        for local_file_path, source, name in links:
+            if os.path.exists(local_file_path):
+                link_source_copy(screenshots_path, local_file_path, source, name)
+        if backfill and not stop_event.is_set():
+            index.set_meta(backfill_key, time.time())
     time_out = time.time()-time_in
     log_message(f"Screenshots sync loop time: {time_out}")
-
-def sync_files(ftp, server_path, output_path):
+    return len(jobs)
+
+def sync_files(pool, server_path, output_path, snapshots=False, sync_filter=None, direction='download'):
+    sync_filter = sync_filter or SyncFilter()
+    with metrics.cycle(console_label(pool.console, server_path)):
+        changes = 0
+        downloaded = set()
+        # On two-way paths the newer copy of a file wins, the upload pass pushes local files the download pass left alone
+        if direction in ('download', 'both'):
+            changes = sync_files_cycle(pool, server_path, output_path, snapshots, sync_filter, direction == 'both', downloaded)
+            if changes is None:
+                return None
+        if direction in ('upload', 'both'):
+            uploaded = upload_files_cycle(pool, server_path, output_path, sync_filter, direction == 'both', downloaded)
+            if uploaded is None:
+                return None
+            changes += uploaded
+        return changes
+
+class SyncFilter:
+    # Rules of one File Sync path, checked during the walk so excluded folders are never listed.
+    # Patterns are globs matched against the path below server_path (or just the name, if they
+    # have no slash), or regular expressions when they start with "re:".
+    def __init__(self, include=(), exclude=(), max_depth=0, max_size=0):
+        self.include = [self.compile(pattern) for pattern in include]
+        self.exclude = [self.compile(pattern) for pattern in exclude]
+        self.max_depth = max_depth
+        self.max_size = max_size
+        # Changing the rules invalidates the remembered folder listings
+        self.key = "" if not (include or exclude or max_depth or max_size) else \
+            hashlib.sha1(repr((list(include), list(exclude), max_depth, max_size)).encode('utf-8')).hexdigest()[:12]
+
+    @staticmethod
+    def compile(pattern):
+        if pattern.startswith('re:'):
+            regex = re.compile(pattern[3:])
+            return lambda relative_path, name: regex.search(relative_path) is not None
+        pattern = pattern.rstrip('/')
+        if '/' in pattern:
+            return lambda relative_path, name: fnmatch.fnmatchcase(relative_path, pattern.lstrip('/'))
+        return lambda relative_path, name: fnmatch.fnmatchcase(name, pattern)
+
+    @staticmethod
+    def matches(rules, relative_path, name):
+        return any(rule(relative_path, name) for rule in rules)
+
+    def __eq__(self, other):
+        return isinstance(other, SyncFilter) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def allows_dir(self, relative_path, name):
+        # Include rules pick files, so folders are only ever left out by exclude rules and depth
+        if self.max_depth and relative_path.count('/') + 1 > self.max_depth:
+            return False
+        return not self.matches(self.exclude, relative_path, name)
+
+    def allows_file(self, relative_path, name, size):
+        if self.max_size and size is not None and size > self.max_size:
+            return False
+        if self.matches(self.exclude, relative_path, name):
+            return False
+        return not self.include or self.matches(self.include, relative_path, name)
+
+def split_patterns(value):
+    return [pattern.strip() for pattern in value.split(',') if pattern.strip()]
+
+def listing_fingerprint(entries):
+    digest = hashlib.sha1()
+    for entry in sorted(entries, key=lambda entry: entry.name):
+        digest.update(f"{entry.name}|{entry.type}|{entry_fingerprint(entry)}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def entry_fingerprint(entry):
+    # A folder's entry changes when files are added to or removed from it, if the server reports folder times
+    return f"{entry.size}|{entry.modify.timestamp() if entry.modify else ''}"
+
+def sync_files_cycle(pool, server_path, output_path, snapshots, sync_filter, two_way=False, downloaded=None):
+    # downloaded collects the local paths of the files queued for download, whether or not they finish
     time_in = time.time()
     log_message(f"Syncing {server_path} to {output_path}")
+    index = get_sync_index()
+    jobs = []
+    snapshot = LocalSnapshot(output_path)
+    store = get_snapshot_store(server_path, output_path) if snapshots else None
+
+    # Walk every folder now and then, since a file rewritten in place doesn't change the entry of its folder
+    verify_key = sync_state_key("verified", pool.console, server_path, output_path)
+    seen = []  # files listed by a full verify
+    full_verify = time.time() - (index.get_meta(verify_key) or 0) >= FULL_VERIFY_INTERVAL
+    root_path = server_path
+
+    def local_matches(entry, local_file_path):
+        # The index only knows what was synced, a full verify also catches local copies deleted or cut short since
+        local = snapshot.stat(local_file_path)
+        return local is not None and (entry.size is None or local[1] == entry.size)
+
+    def process_files(ftp, server_path, output_path, dir_entry=None):
+        # Returns True when everything below server_path is listed and current
+        stored = index.get_dir(server_path, output_path)
+        own_entry = (entry_fingerprint(dir_entry) if dir_entry else '') + sync_filter.key
+        if dir_entry is not None and stored and stored[1] == own_entry and not full_verify:
+            metrics.add('dirs_pruned')
+            return True
 
-    def process_files(ftp, server_path, output_path):
         try:
-            ftp.cwd(server_path)
-            files = ftp.nlst()
+            entries = list_directory(ftp, server_path)
+        except ftplib.all_errors as e:
+            log_message(f"Error listing files in {server_path}: {e}")
+            return False
+
+        listing = listing_fingerprint(entries) + sync_filter.key
+        unchanged = stored is not None and stored[0] == listing and not full_verify
+        complete = True
+        jobs_before = len(jobs)
+        for entry in entries:
+            local_file_path = os.path.join(output_path, entry.name)
+            relative_path = posixpath.relpath(entry.path, root_path)
+
+            if entry.type == 'dir':
+                if not sync_filter.allows_dir(relative_path, entry.name):
+                    metrics.add('dirs_filtered')
+                elif not process_files(ftp, entry.path, local_file_path, entry):
+                    complete = False
+                continue
+
+            if not sync_filter.allows_file(relative_path, entry.name, entry.size):
+                metrics.add('files_filtered')
+                continue
+            if full_verify:
+                seen.append(entry)
+
+            # Same listing as when every file here was last found current
+            if unchanged:
+                continue
+            metrics.add('files_checked')
+            if index.is_current(entry, local_file_path) and (not full_verify or local_matches(entry, local_file_path)):
+                metrics.add('files_skipped')
+                continue
+            remote_timestamp = entry.modify or get_file_timestamp(ftp, entry.path)
+            if not remote_timestamp:
+                log_message(f"Failed to get timestamp for {entry.path}, comparing by size only")
+            local = snapshot.stat(local_file_path) if two_way else None
+            if local and remote_timestamp and datetime.fromtimestamp(local[0]) > remote_timestamp:
+                continue
+            job = make_download_job(ftp, index, entry, remote_timestamp, local_file_path, entry.name, snapshot, store)
+            if job:
+                jobs.append(job)
+
+        # Folders with downloads pending are walked again next cycle, so a failed download is retried
+        if complete and len(jobs) == jobs_before:
+            index.set_dir(server_path, output_path, listing, own_entry)
+            return True
+        return False
 
-            for file in files:
-                full_path = os.path.join(server_path, file)
-                relative_path = os.path.relpath(full_path, server_path)
-                local_file_path = os.path.join(output_path, relative_path)
+    with pool.session() as ftp:
+        if ftp is None:
+            return None
+        complete = process_files(ftp, server_path, output_path)
+    if full_verify and complete:
+        index.set_meta(verify_key, time.time())
+    if full_verify:
+        # Only full walks see the same files every time
+        remember_identity(pool.console, server_path, seen)
+    if downloaded is not None:
+        downloaded.update(os.path.normpath(job.local_path) for job in jobs)
+    transfer_files(pool, jobs, 1)
+    if store:
+        if not store.snapshots():
+            store.add_tree()
+        store.commit()
+
+    time_out = time.time()-time_in
+    log_message(f"{server_path} sync loop time: {time_out}")
+    return len(jobs)
+
+# Files waiting for upload, handed out in one batch per upload worker
+UploadJob = namedtuple('UploadJob', ['local_path', 'relative_path', 'remote_path', 'size', 'mtime'])
+
+def list_remote_tree(ftp, root, sync_filter):
+    # Files by path below root and the folders that exist, an empty tree if root doesn't exist yet
+    files = {}
+    dirs = set()
+    pending = ['']
+    while pending:
+        relative_path = pending.pop()
+        try:
+            entries = list_directory(ftp, posixpath.join(root, relative_path) if relative_path else root)
+        except ftplib.error_perm:
+            if relative_path:
+                raise
+            return files, dirs
+        dirs.add(relative_path)
+        for entry in entries:
+            child = posixpath.join(relative_path, entry.name) if relative_path else entry.name
+            if entry.type == 'dir':
+                if sync_filter.allows_dir(child, entry.name):
+                    pending.append(child)
+            else:
+                files[child] = entry
+    return files, dirs
+
+def list_local_tree(root, sync_filter):
+    # relative path -> (local path, size, mtime)
+    files = {}
+    pending = ['']
+    while pending:
+        relative_path = pending.pop()
+        try:
+            with os.scandir(os.path.join(root, relative_path)) as it:
+                for entry in it:
+                    child = posixpath.join(relative_path, entry.name) if relative_path else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name != STAGING_DIR_NAME and sync_filter.allows_dir(child, entry.name):
+                            pending.append(child)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        if sync_filter.allows_file(child, entry.name, stat.st_size):
+                            files[child] = (entry.path, stat.st_size, stat.st_mtime)
+        except OSError:
+            continue
+    return files
+
+def make_remote_dirs(ftp, root, relative_path, remote_dirs, lock):
+    parent = posixpath.dirname(relative_path)
+    if relative_path and parent not in remote_dirs:
+        make_remote_dirs(ftp, root, parent, remote_dirs, lock)
+    with lock:
+        if relative_path in remote_dirs:
+            return
+    try:
+        ftp.mkd(posixpath.join(root, relative_path) if relative_path else root)
+    except ftplib.error_perm:
+        pass  # Made by another upload worker in the meantime, or STOR reports the real problem
+    with lock:
+        remote_dirs.add(relative_path)
 
+def remote_file_exists(ftp, remote_path):
+    try:
+        ftp.size(remote_path)
+        return True
+    except ftplib.error_perm:
+        return False
+
+def discard_remote_file(ftp, remote_path):
+    try:
+        ftp.delete(remote_path)
+    except ftplib.error_perm as e:
+        log_message(f"Could not delete {remote_path}: {e}")
+
+def upload_file(ftp, local_path, remote_path, mtime):
+    # Upload next to the target and rename it into place, so the console never sees half a file.
+    # Returns the remote time of the uploaded file, if the server reports one.
+    temp_path = posixpath.join(posixpath.dirname(remote_path), f".{posixpath.basename(remote_path)}.part")
+    rename = getattr(ftp, 'rename_supported', True)
+
+    def sent(block):
+        if bandwidth_limit:
+            bandwidth_limit.consume(len(block))
+        metrics.add('bytes_uploaded', len(block))
+
+    with open(local_path, 'rb') as f:
+        ftp.storbinary(f'STOR {temp_path if rename else remote_path}', f, callback=sent)
+    if rename:
+        try:
+            ftp.rename(temp_path, remote_path)
+        except ftplib.error_perm as e:
+            if str(e)[:3] in ('500', '502', '504'):
+                # No RNFR/RNTO, store files in place from now on
+                ftp.rename_supported = False
+                ftp.delete(temp_path)
+                return upload_file(ftp, local_path, remote_path, mtime)
+            if not remote_file_exists(ftp, remote_path):
+                # Nothing in the way, so the rename itself failed. Leave no temporary file behind.
+                discard_remote_file(ftp, temp_path)
+                raise
+            # Some servers can't rename over an existing file. Move the old copy aside rather than
+            # deleting it, so it can be put back if the rename still fails.
+            old_path = posixpath.join(posixpath.dirname(remote_path), f".{posixpath.basename(remote_path)}.old")
+            ftp.rename(remote_path, old_path)
+            try:
+                ftp.rename(temp_path, remote_path)
+            except ftplib.error_perm:
+                ftp.rename(old_path, remote_path)
+                discard_remote_file(ftp, temp_path)
+                raise
+            discard_remote_file(ftp, old_path)
+
+    # Give the console copy the local time, so the download side sees both copies as the same
+    if has_feature(ftp, 'MFMT'):
+        remote_timestamp = datetime.fromtimestamp(int(mtime))
+        try:
+            ftp.sendcmd(f"MFMT {remote_timestamp.strftime('%Y%m%d%H%M%S')} {remote_path}")
+            return remote_timestamp
+        except ftplib.error_perm:
+            pass
+    return get_file_timestamp(ftp, remote_path)
+
+def upload_batch(pool, root, batch, remote_dirs, lock, metrics_path):
+    index = get_sync_index()
+    uploaded = 0
+    metrics.set_path(metrics_path)
+    try:
+        with pool.session() as ftp:
+            if ftp is None:
+                return 0
+            for job in batch:
+                if stop_event.is_set():
+                    break
+                time_in = time.time()
                 try:
-                    ftp.cwd(full_path)
-                    process_files(ftp, full_path, local_file_path)
-                    ftp.cwd('..')
-                except ftplib.error_perm:
-                    remote_timestamp = get_file_timestamp(ftp, full_path)
-                    if remote_timestamp:
-                        local_dir = os.path.dirname(local_file_path)
-                        if not os.path.exists(local_dir):
-                            os.makedirs(local_dir, exist_ok=True)
-
-                        local_timestamp = remote_timestamp
-                        if (os.path.exists(local_file_path)):
-                            local_timestamp = datetime.fromtimestamp(os.path.getmtime(local_file_path))
-                        if not os.path.exists(local_file_path) or remote_timestamp > local_timestamp:
-                            log_message(f"Downloading {full_path} to {local_file_path}")
-                            download_file(ftp, full_path, local_file_path)
-                            os.utime(local_file_path, (remote_timestamp.timestamp(), remote_timestamp.timestamp()))
-                            log_message(f"Downloaded: {full_path}")
-                            if remote_timestamp > local_timestamp:
-                                notify_file(os.path.basename(full_path), local_file_path, "update")
-                            else:
-                                notify_file(os.path.basename(full_path), local_file_path, "new")
-                    else:
-                        log_message(f"Failed to get timestamp for {full_path}")
+                    make_remote_dirs(ftp, root, posixpath.dirname(job.relative_path), remote_dirs, lock)
+                    remote_timestamp = upload_file(ftp, job.local_path, job.remote_path, job.mtime)
+                except ftplib.all_errors as e:
+                    log_message(f"Error uploading {job.local_path} to {job.remote_path}: {e}")
+                    if not pool.is_alive(ftp):
+                        # Session died mid-transfer, hand it back closed and leave the rest for the next cycle
+                        ftp.close()
+                        break
+                    continue
+                finally:
+                    metrics.add('upload_seconds', time.time() - time_in)
+                # The download side finds this version current, instead of fetching it straight back
+                entry = RemoteEntry(job.remote_path, posixpath.basename(job.remote_path), 'file', job.size, remote_timestamp)
+                index.mark(entry, job.local_path, 'done')
+                index.mark_uploaded(job.local_path, job.remote_path, job.size, job.mtime)
+                metrics.add('files_uploaded')
+                log_message(f"Uploaded: {job.remote_path}")
+                uploaded += 1
+    finally:
+        metrics.set_path(None)
+    return uploaded
+
+def upload_files_cycle(pool, server_path, output_path, sync_filter, two_way=False, downloaded=()):
+    time_in = time.time()
+    log_message(f"Uploading {output_path} to {server_path}")
+    index = get_sync_index()
+    local_files = list_local_tree(output_path, sync_filter)
+
+    with pool.session() as ftp:
+        if ftp is None:
+            return None
+        try:
+            remote_files, remote_dirs = list_remote_tree(ftp, server_path, sync_filter)
         except ftplib.all_errors as e:
             log_message(f"Error listing files in {server_path}: {e}")
-
-    process_files(ftp, server_path, output_path)
+            return 0
+
+    jobs = []
+    avoided = 0
+    for relative_path, (local_path, size, mtime) in local_files.items():
+        remote = remote_files.get(relative_path)
+        remote_path = posixpath.join(server_path, relative_path)
+        # The console has this version already if it was uploaded from here, or isn't older than the local copy
+        if remote is not None and remote.size == size and (
+                index.is_uploaded(local_path, remote_path, size, mtime)
+                or remote.modify is None or datetime.fromtimestamp(mtime) <= remote.modify):
+            avoided += size
+            continue
+        if two_way and (os.path.normpath(local_path) in downloaded or remote is not None and (
+                remote.modify is None or datetime.fromtimestamp(int(mtime)) <= remote.modify)):
+            # The download pass took this file from the console, or tried to, so the console copy is
+            # at least as new. Uploading it again would overwrite newer data if that download failed.
+            continue
+        jobs.append(UploadJob(local_path, relative_path, remote_path, size, mtime))
+    metrics.add('upload_bytes_avoided', avoided)
+
+    uploaded = 0
+    if jobs:
+        # Largest files first, each to the lightest batch, so the batches finish together
+        batches = [[] for _ in range(min(len(jobs), max(1, min(DOWNLOAD_WORKERS, pool.max_sessions))))]
+        sizes = [0] * len(batches)
+        for job in sorted(jobs, key=lambda job: job.size, reverse=True):
+            lightest = sizes.index(min(sizes))
+            batches[lightest].append(job)
+            sizes[lightest] += job.size
+        lock = threading.Lock()
+        futures = [
+            submit_transfer(upload_batch, pool, server_path, batch, remote_dirs, lock, metrics.current_path())
+            for batch in batches
+        ]
+        uploaded = sum(future.result() for future in futures)
+        log_message(f"Uploaded {uploaded} of {len(jobs)} changed files, {avoided} bytes not uploaded again")
 
     time_out = time.time()-time_in
-    log_message(f"{server_path} sync loop time: {time_out}")
+    log_message(f"{output_path} upload loop time: {time_out}")
+    return uploaded
+
+def read_file_sync_paths(section):
+    # Sync paths are numbered server_path_1, server_path_2, ... with no upper limit
+    sync_paths = []
+    numbers = sorted(int(key[len('server_path_'):]) for key in config.options(section)
+                     if key.startswith('server_path_') and key[len('server_path_'):].isdigit())
+    for i in numbers:
+        server_path = config.get(section, f'server_path_{i}', fallback='').strip('"')
+        output_path = config.get(section, f'output_path_{i}', fallback='').strip('"')
+        sync_files = config.getboolean(section, f'sync_files_{i}', fallback=False)
+        check_rate = config.getint(section, f'check_rate_{i}', fallback=CHECK_RATE)
+        snapshots = config.getboolean(section, f'snapshots_{i}', fallback=False)
+        direction = config.get(section, f'direction_{i}', fallback='download').strip().lower()
+        if direction not in ('download', 'upload', 'both'):
+            log_message(f"Unknown direction_{i} = {direction}, only downloading")
+            direction = 'download'
+        try:
+            sync_filter = SyncFilter(
+                split_patterns(config.get(section, f'include_{i}', fallback='')),
+                split_patterns(config.get(section, f'exclude_{i}', fallback='')),
+                config.getint(section, f'max_depth_{i}', fallback=0),
+                config.getint(section, f'max_size_{i}', fallback=0) * 1024
+            )
+        except re.error as e:
+            log_message(f"Invalid pattern for server_path_{i}, syncing it without filters: {e}")
+            sync_filter = SyncFilter()
+        if server_path and output_path and sync_files:
+            sync_paths.append(SyncPath(server_path, output_path, check_rate, snapshots, sync_filter, direction))
+    return sync_paths
+
+def read_console(section):
+    # [FTP <name>] holds the connection settings, screenshot output and File Sync paths of one more Switch
+    return Console(
+        section[len('FTP '):].strip(),
+        config.get(section, 'server', fallback='').strip('"'),
+        config.getint(section, 'port', fallback=5000),
+        config.get(section, 'user', fallback='root').strip('"'),
+        config.get(section, 'pass', fallback='').strip('"'),
+        config.getint(section, 'max_sessions', fallback=MAX_SESSIONS),
+        config.get(section, 'output_path', fallback='').strip('"'),
+        config.getboolean(section, 'sync_screenshots', fallback=False),
+        config.getint(section, 'check_rate', fallback=SCREENSHOTS_CHECK_RATE),
+        read_file_sync_paths(section)
+    )
+
+# Settings reload_config() compares against their previous values
+RELOAD_SETTINGS = (
+    'WORKERS', 'KEEPALIVE_INTERVAL', 'MAX_BANDWIDTH', 'POST_PROCESS', 'PROCESSED_PATH', 'THUMBNAIL_SIZE',
+    'THUMBNAIL_FORMAT', 'POST_PROCESS_WORKERS'
+)
 
 def reload_config():
     global SERVER, PORT, USER, PASS, SCREENSHOTS_PATH, DT_FORMAT, SYNC_SCREENSHOTS, file_sync_paths, CHECK_RATE, AUTO_START
+    global ALBUM_SCAN, FULL_SCAN_INTERVAL, SCREENSHOTS_CHECK_RATE, FAST_CHECK_RATE, FAST_WINDOW, MAX_BACKOFF, JITTER
+    global MAX_SESSIONS, KEEPALIVE_INTERVAL, DOWNLOAD_WORKERS, PREALLOCATE, FSYNC, METRICS_PORT, transfer_executor, consoles, WORKERS
+    global NOTIFICATION_INTERVAL, MAX_BANDWIDTH, bandwidth_limit, FULL_VERIFY_INTERVAL, SOURCE_FOLDERS, SNAPSHOT_KEEP
+    global POST_PROCESS, PROCESSED_PATH, THUMBNAIL_SIZE, THUMBNAIL_FORMAT, POST_PROCESS_WORKERS
+    global DISCOVERY, DISCOVERY_TIMEOUT, DISCOVERY_WORKERS, DISCOVERY_BANNER
+    previous = {name: globals().get(name) for name in RELOAD_SETTINGS}
+    # Start over, so options removed from the file are gone too
+    config.clear()
     config.read(config_path)
     SERVER = config.get('FTP', 'server').strip('"')
     PORT = config.getint('FTP', 'port')
@@ -375,376 +2665,354 @@ def reload_config():
     # Screenshots settings
     SCREENSHOTS_PATH = config.get('Screenshots', 'output_path').strip('"')
     DT_FORMAT = config.get('Screenshots', 'dt_format')
-    SYNC_SCREENSHOTS = config.get('Screenshots', 'sync_screenshots')
-    
-    # Update sync paths
-    file_sync_paths = []
-    for i in range(1, 6):
-        server_path = config.get('File Sync', f'server_path_{i}', fallback='').strip('"')
-        output_path = config.get('File Sync', f'output_path_{i}', fallback='').strip('"')
-        sync_files = config.get('File Sync', f'sync_files_{i}', fallback=False)
-        if server_path and output_path and sync_files:
-            file_sync_paths.append((server_path, output_path))
+    SYNC_SCREENSHOTS = config.getboolean('Screenshots', 'sync_screenshots')
+    ALBUM_SCAN = config.getboolean('Screenshots', 'album_scan', fallback=True)
+    FULL_SCAN_INTERVAL = config.getint('Screenshots', 'full_scan_interval', fallback=86400)
+    SOURCE_FOLDERS = config.getboolean('Screenshots', 'source_folders', fallback=False)
+    POST_PROCESS = []
+    for stage in config.get('Screenshots', 'post_process', fallback='').split(','):
+        stage = stage.strip().lower()
+        if stage in POST_PROCESS_STAGES:
+            POST_PROCESS.append(stage)
+        elif stage:
+            log_message(f"Unknown post-processing stage: {stage}")
+    PROCESSED_PATH = config.get('Screenshots', 'processed_path', fallback='').strip('"') or os.path.join(SCREENSHOTS_PATH, "Processed")
+    THUMBNAIL_SIZE = config.getint('Screenshots', 'thumbnail_size', fallback=320)
+    THUMBNAIL_FORMAT = config.get('Screenshots', 'thumbnail_format', fallback='webp').strip().lower()
+    FULL_VERIFY_INTERVAL = config.getint('File Sync', 'full_verify_interval', fallback=600)
+    SNAPSHOT_KEEP = config.getint('File Sync', 'snapshot_keep', fallback=0)
 
     CHECK_RATE = int(config.get('Settings', 'check_rate'))
-    AUTO_START = config.getboolean('Settings', 'auto_start')
-
-class ConfigDialog(QtWidgets.QDialog):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.setWindowTitle("Configure Switch FTP Sync")
-        self.layout = QtWidgets.QFormLayout(self)
-        self.setFixedWidth(480)
-
-        self.config_items = {}
-        self.browse_buttons = {}  # To keep track of browse buttons and their corresponding line edits
-        for section in config.sections():
-            if section != 'DEFAULT':
-                if section != 'FTP':
-                    self.layout.addRow(QtWidgets.QLabel(""))
-                label = QtWidgets.QLabel(f"{section}")
-                font = label.font()
-                font.setBold(True)
-                label.setFont(font)
-                self.layout.addRow(label)
-                self.layout.addRow(QtWidgets.QFrame())
-            for key, value in config.items(section):
-                item_label = key
-                if key.startswith('sync_files') or key == 'sync_screenshots' or key == "auto_start":
-                    continue  # Skip these keys for now
-                line_edit = QtWidgets.QLineEdit(value.strip('"'))
-                line_edit.setAlignment(QtCore.Qt.AlignRight)  # Align text to the right
-                self.config_items[f"{section}.{key}"] = line_edit
-
-                if key.startswith('output_path') or key == 'output_path':
-                    browse_button = QtWidgets.QPushButton('\uD83D\uDCC2')  # Folder icon
-                    self.browse_buttons[browse_button] = line_edit  # Associate browse button with line edit
-                    browse_button.clicked.connect(self.handle_browse_button_clicked)
-                    hbox = QtWidgets.QHBoxLayout()
-                    line_edit.setFixedWidth(240)  # Adjust the width of the input box
-                    hbox.addWidget(line_edit)
-                    hbox.addWidget(browse_button)
-                    checkbox = QtWidgets.QCheckBox()
-                    if key == 'output_path':
-                        checkbox.setChecked(config.getboolean(section, 'sync_screenshots'))
-                        self.config_items[f"{section}.sync_screenshots"] = checkbox
-                    else:
-                        sync_key = key.replace('output_path', 'sync_files')
-                        checkbox.setChecked(config.getboolean(section, sync_key))
-                        self.config_items[f"{section}.{sync_key}"] = checkbox
-                    hbox.addWidget(checkbox)
-                    self.layout.addRow(QtWidgets.QLabel(f"  {item_label} "), hbox)
-                else:
-                    line_edit.setFixedWidth(300)  # Adjust the width of the input box
-                    self.layout.addRow(QtWidgets.QLabel(f"  {item_label} "), line_edit)  # Added indent for key name
-
-        self.button_box = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel)
-        self.button_box.accepted.connect(self.update_config)
-        self.button_box.rejected.connect(self.reject)
-        self.layout.addRow(self.button_box)
-
-    def handle_browse_button_clicked(self):
-        sender = self.sender()
-        if sender in self.browse_buttons:
-            line_edit = self.browse_buttons[sender]
-            self.select_output_directory(line_edit)
-
-    def select_output_directory(self, line_edit):
-        dir_path = QtWidgets.QFileDialog.getExistingDirectory(self, "Select Directory")
-        if dir_path:
-            if not dir_path.endswith('/'):
-                dir_path += '/'
-            line_edit.setText(dir_path)
-
-    def update_config(self):
-        try:
-            for item_label, widget in self.config_items.items():
-                section, key = item_label.split('.')
-                if isinstance(widget, QtWidgets.QLineEdit):
-                    config.set(section, key, widget.text())
-                elif isinstance(widget, QtWidgets.QCheckBox):
-                    config.set(section, key, str(widget.isChecked()))
-            with open(config_path, 'w') as configfile:
-                config.write(configfile)
-            QtWidgets.QMessageBox.information(self, "Success", "Configuration updated successfully.")
-            reload_config()
-        except Exception as e:
-            QtWidgets.QMessageBox.critical(self, "Error", f"Failed to update configuration: {e}")
-        self.accept()  # Close the dialog
-
-
-
-
-class AboutDialog(QtWidgets.QDialog):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.setWindowTitle("About Switch FTP Sync")
-        self.layout = QtWidgets.QVBoxLayout(self)
-        self.setFixedSize(360, 250)
-
-        icon_path = os.path.join(script_dir, "icon.png")
-        if os.path.exists(icon_path):
-            icon_label = QtWidgets.QLabel()
-            pixmap = QtGui.QPixmap(icon_path).scaled(80, 80, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
-            icon_label.setPixmap(pixmap)
-            icon_label.setAlignment(QtCore.Qt.AlignCenter)
-            self.layout.addWidget(icon_label)
-
-        title_label = QtWidgets.QLabel(f"{TITLE} v{VERSION}")
-        title_label.setAlignment(QtCore.Qt.AlignCenter)
-        font = title_label.font()
-        font.setPointSize(14)
-        font.setBold(True)
-        title_label.setFont(font)
-        self.layout.addWidget(title_label)
-
-        description_label = QtWidgets.QLabel("Nintendo Switch FTP data-syncing utility.")
-        description_label.setAlignment(QtCore.Qt.AlignCenter)
-        self.layout.addWidget(description_label)
-
-        author_label = QtWidgets.QLabel(f"Created by {AUTHOR}")
-        author_label.setAlignment(QtCore.Qt.AlignCenter)
-        self.layout.addWidget(author_label)
-
-        github_button = QtWidgets.QPushButton("View on GitHub")
-        github_button.setFixedWidth(120)  # Set fixed width for the button
-        github_button.clicked.connect(lambda: webbrowser.open("https://github.com/ppkantorski/Switch-FTP-Sync"))
-
-        check_updates_button = QtWidgets.QPushButton("Check for Updates")
-        check_updates_button.setFixedWidth(140)  # Set fixed width for the button
-        check_updates_button.clicked.connect(self.check_for_updates)
-
-        ok_button = QtWidgets.QPushButton("OK")
-        ok_button.setFixedWidth(60)  # Set fixed width for the button
-        ok_button.clicked.connect(self.accept)
-
-        # Create a horizontal layout for the buttons
-        button_layout = QtWidgets.QHBoxLayout()
-        button_layout.addWidget(github_button)
-        button_layout.addWidget(check_updates_button)
-        button_layout.addWidget(ok_button)
-
-        # Add the horizontal layout to the main layout
-        self.layout.addLayout(button_layout)
-
-        self.layout.setAlignment(github_button, QtCore.Qt.AlignCenter)
-        self.layout.setAlignment(check_updates_button, QtCore.Qt.AlignCenter)
-        self.layout.setAlignment(ok_button, QtCore.Qt.AlignCenter)
-
-    def check_for_updates(self):
-        try:
-            response = requests.get("https://api.github.com/repos/ppkantorski/Switch-FTP-Sync/releases/latest")
-            response.raise_for_status()  # Raise an exception for HTTP errors
-            latest_release = response.json()
-            latest_version = latest_release["tag_name"].replace("v", "")
+    SCREENSHOTS_CHECK_RATE = config.getint('Screenshots', 'check_rate', fallback=CHECK_RATE)
+    FAST_CHECK_RATE = config.getint('Settings', 'fast_check_rate', fallback=3)
+    FAST_WINDOW = config.getint('Settings', 'fast_window', fallback=120)
+    MAX_BACKOFF = config.getint('Settings', 'max_backoff', fallback=300)
+    JITTER = config.getfloat('Settings', 'jitter', fallback=0.1)
     
-            # Split versions into parts and compare each part
-            latest_version_parts = [int(part) for part in latest_version.split('.')]
-            current_version_parts = [int(part) for part in VERSION.split('.')]
-    
-            if latest_version_parts > current_version_parts:
-                QtWidgets.QMessageBox.information(self, "Update Available", 
-                                                  f"\nA new version v{latest_version} is available.\nYou are currently using v{VERSION}.")
-            else:
-                QtWidgets.QMessageBox.information(self, "Up to Date", 
-                                                  "\nYou are using the latest version.")
-        except requests.RequestException as e:
-            QtWidgets.QMessageBox.critical(self, "Error", f"\nFailed to check for updates: {e}")
-        except ValueError as e:
-            QtWidgets.QMessageBox.critical(self, "Error", f"\nFailed to parse version information: {e}")
-    
-
+    file_sync_paths = read_file_sync_paths('File Sync')
 
-
-class SystemTrayApp(QtWidgets.QSystemTrayIcon):
-    def __init__(self, icon, parent=None):
-        super(SystemTrayApp, self).__init__(icon, parent)
-        self.setToolTip(f"{TITLE} v{VERSION}")
-        self.parent = parent
-        self.menu = QtWidgets.QMenu(parent)
-
-        self.start_action = self.menu.addAction("\u25B6 Start Data Sync")
-        self.auto_start_action = self.menu.addAction("    Auto-Start")
-        self.menu.addSeparator()
-        self.config_action = self.menu.addAction("    Configure...")
-        self.menu.addSeparator()
-        self.about_action = self.menu.addAction("    About Switch FTP Sync    ")
-        self.menu.addSeparator()
-        self.restart_action = self.menu.addAction("    Restart")  # Add Restart action
-        self.exit_action = self.menu.addAction("    Quit")
-
-        self.start_action.triggered.connect(self.toggle_capture)
-        self.auto_start_action.triggered.connect(self.toggle_auto_start)
-        self.config_action.triggered.connect(self.configure_config)
-        self.about_action.triggered.connect(self.show_about_dialog)
-        self.restart_action.triggered.connect(self.restart_app)  # Connect Restart action to method
-        self.exit_action.triggered.connect(self.exit_app)
-
-        self.setContextMenu(self.menu)
-        self.update_auto_start_action()
-
-        if AUTO_START:
-            self.start_capture()
-
-    def toggle_capture(self):
-        global running
-        if running:
-            self.stop_capture()
-        else:
-            self.start_capture()
-
-    def start_capture(self):
-        global running
-        if not running:
-            running = True
-            stop_event.clear()
-            threading.Thread(target=self.sync_data, daemon=True).start()
-            self.start_action.setText("\u25A0 Stop Data Sync")
-        else:
-            log_message("Switch FTP Sync is already running.")
-
-    def stop_capture(self):
-        global running
-        if running:
-            running = False
-            stop_event.set()
-            self.start_action.setText("\u25B6 Start Data Sync")
-        else:
-            log_message("Switch FTP Sync is not running.")
-
-    def sync_data(self):
-        global running
-    
-        def sync_screenshots_thread():
-            while running and not stop_event.is_set():
-                start_time = time.time()
-                ftp = None
-                try:
-                    ftp = connect_ftp()
-                    if ftp:
-                        sync_screenshots(ftp)
-                except ftplib.all_errors as e:
-                    log_message(f"Error during sync operation: {e}")
-                finally:
-                    if ftp:
-                        try:
-                            ftp.quit()
-                        except ftplib.all_errors as e:
-                            log_message(f"Error quitting FTP: {e}")
-                elapsed_time = time.time() - start_time
-                sleep_time = max(0, CHECK_RATE - elapsed_time)
-                time.sleep(sleep_time)
-    
-        def sync_single_file_path(server_path, output_path):
-            while running and not stop_event.is_set():
-                start_time = time.time()
-                ftp = None
-                try:
-                    ftp = connect_ftp()
-                    if ftp:
-                        sync_files(ftp, server_path, output_path)
-                except ftplib.all_errors as e:
-                    log_message(f"Error during sync operation: {e}")
-                finally:
-                    if ftp:
-                        try:
-                            ftp.quit()
-                        except ftplib.all_errors as e:
-                            log_message(f"Error quitting FTP: {e}")
-                elapsed_time = time.time() - start_time
-                sleep_time = max(0, CHECK_RATE - elapsed_time)
-                time.sleep(sleep_time)
-    
-        # Create and start a thread for syncing screenshots
-        if SYNC_SCREENSHOTS:
-            threading.Thread(target=sync_screenshots_thread, daemon=True).start()
-    
-        # Create and start a thread for each file sync path
-        for server_path, output_path in file_sync_paths:
-            threading.Thread(target=sync_single_file_path, args=(server_path, output_path), daemon=True).start()
-    
-        # Keep the main thread alive while syncing is running
-        while running and not stop_event.is_set():
-            time.sleep(1)
+    AUTO_START = config.getboolean('Settings', 'auto_start')
+    MAX_SESSIONS = config.getint('Settings', 'max_sessions', fallback=3)
+    WORKERS = config.getint('Settings', 'workers', fallback=MAX_SESSIONS)
+    KEEPALIVE_INTERVAL = config.getint('Settings', 'keepalive_interval', fallback=30)
+    DOWNLOAD_WORKERS = config.getint('Settings', 'download_workers', fallback=2)
+    PREALLOCATE = config.getboolean('Settings', 'preallocate', fallback=False)
+    FSYNC = config.get('Settings', 'fsync', fallback='none').strip().lower()
+    METRICS_PORT = config.getint('Settings', 'metrics_port', fallback=0)
+    NOTIFICATION_INTERVAL = config.getfloat('Settings', 'notification_interval', fallback=5)
+    DISCOVERY = config.getboolean('Settings', 'discovery', fallback=False)
+    DISCOVERY_TIMEOUT = config.getfloat('Settings', 'discovery_timeout', fallback=1)
+    DISCOVERY_WORKERS = config.getint('Settings', 'discovery_workers', fallback=32)
+    DISCOVERY_BANNER = split_patterns(config.get('Settings', 'discovery_banner', fallback='Hello!'))
+    MAX_BANDWIDTH = config.getint('Settings', 'max_bandwidth', fallback=0)
+    POST_PROCESS_WORKERS = config.getint('Settings', 'post_process_workers', fallback=1)
+
+    consoles = [Console("", SERVER, PORT, USER, PASS, MAX_SESSIONS, SCREENSHOTS_PATH, SYNC_SCREENSHOTS,
+                        SCREENSHOTS_CHECK_RATE, file_sync_paths)]
+    for section in config.sections():
+        if section.startswith('FTP ') and section[len('FTP '):].strip():
+            console = read_console(section)
+            if console.server:
+                consoles.append(console)
+            else:
+                log_message(f"No server set in [{section}], skipping it")
+
+    # Only rebuild what the new settings change, so warm sessions and queued work survive a reload
+    def changed(*names):
+        return any(previous[name] != globals()[name] for name in names)
+
+    if changed('MAX_BANDWIDTH'):
+        bandwidth_limit = TokenBucket(MAX_BANDWIDTH * 1024) if MAX_BANDWIDTH > 0 else None
+    with ftp_pool_lock:
+        for name, pool in list(ftp_pools.items()):
+            console = get_console(name)
+            old = pool.console
+            if console is None or (console.server, console.port, console.user, console.password) != \
+                    (old.server, old.port, old.user, old.password):
+                # Drop pooled sessions so new connections pick up the new server settings
+                pool.close_all()
+                del ftp_pools[name]
+                continue
+            pool.console = console
+            if console.max_sessions != pool.max_sessions or changed('KEEPALIVE_INTERVAL'):
+                pool.resize(console.max_sessions, KEEPALIVE_INTERVAL)
+    # Resize the shared transfer threads
+    with transfer_executor_lock:
+        if transfer_executor and changed('WORKERS'):
+            transfer_executor.shutdown(wait=False)
+            transfer_executor = None
+    # Unfinished stages stay pending and are picked up with the new settings
+    if changed('POST_PROCESS', 'PROCESSED_PATH', 'THUMBNAIL_SIZE', 'THUMBNAIL_FORMAT', 'POST_PROCESS_WORKERS'):
+        close_post_processor()
+
+    # A running engine starts, stops and retunes its jobs to match
+    if sync_engine:
+        sync_engine.reconfigure()
+
+def load_config(path=None):
+    global config_path, index_path, stats_path, snapshots_path
+    if path:
+        config_path = os.path.abspath(path)
+        index_path = os.path.join(os.path.dirname(config_path), 'sync_state.db')
+        stats_path = os.path.join(os.path.dirname(config_path), 'sync_stats')
+        snapshots_path = os.path.join(os.path.dirname(config_path), 'snapshots')
+
+    # Ensure the config.ini file exists, create a default one if not
+    if not os.path.exists(config_path):
+        with open(config_path, 'w') as config_file:
+            config_file.write(DEFAULT_CONFIG)
+    reload_config()
+
+# One polling job: its console, name in logs and stats, poll interval, cycle function and the arguments after the pool
+SyncJob = namedtuple('SyncJob', ['console', 'name', 'check_rate', 'cycle', 'args'])
+
+def sync_jobs():
+    # The jobs the current settings ask for, keyed so a reload can tell which ones are new, gone or changed
+    jobs = {}
+    for console in consoles:
+        if console.sync_screenshots:
+            jobs[(console.name, "Screenshots")] = SyncJob(
+                console.name, console_label(console, "Screenshots"), console.check_rate, sync_screenshots, ()
+            )
+        for sync_path in console.file_sync_paths:
+            jobs[(console.name, sync_path.server_path, sync_path.output_path)] = SyncJob(
+                console.name, console_label(console, sync_path.server_path), sync_path.check_rate, sync_files,
+                (sync_path.server_path, sync_path.output_path, sync_path.snapshots, sync_path.sync_filter, sync_path.direction)
+            )
+    return jobs
+
+class SyncEngine:
+    def __init__(self):
+        self.loop = None
+        self.stopped = None
+        self.jobs = {}  # key -> SyncJob
+        self.tasks = {}
+        self.wakeups = {}
+        self.metrics_server = None
+        self.metrics_port = 0
+
+    def run(self):
+        import asyncio
+        asyncio.run(self.main())
+
+    def stop(self):
+        # Safe to call from any thread, including signal handlers
+        if self.loop and self.stopped:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def reconfigure(self):
+        # Safe to call from any thread, reload_config() calls it after reading the new settings
+        if self.loop and self.stopped:
+            self.loop.call_soon_threadsafe(self.apply_config)
+
+    def apply_config(self):
+        import asyncio
+        jobs = sync_jobs()
+        for key in [key for key in self.tasks if key not in jobs]:
+            log_message(f"Stopped syncing {self.jobs[key].name}")
+            self.tasks.pop(key).cancel()
+            del self.jobs[key], self.wakeups[key]
+        for key, job in jobs.items():
+            if key not in self.tasks:
+                self.jobs[key] = job
+                self.wakeups[key] = asyncio.Event()
+                self.tasks[key] = asyncio.create_task(self.run_job(key))
+            elif self.jobs[key] != job:
+                # The running job picks up the new settings, keeping its backoff and fast-poll state
+                log_message(f"Updated settings of {job.name}")
+                self.jobs[key] = job
+                self.wakeups[key].set()
+
+        if METRICS_PORT != self.metrics_port:
+            self.stop_metrics_server()
+            self.metrics_server = start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+            self.metrics_port = METRICS_PORT
+        # Picks up stages left pending by the last run or processor
+        get_post_processor()
+
+    def stop_metrics_server(self):
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+
+    async def main(self):
+        import asyncio
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if stop_event.is_set():
+            self.stopped.set()
+        # Blocking ftplib calls run in these threads, one more than the pool for keepalive pings
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=WORKERS + 1, thread_name_prefix="sync"))
+        keepalive = asyncio.create_task(self.keepalive())
+        self.apply_config()
+
+        await self.stopped.wait()
+        tasks = [keepalive, *self.tasks.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop = None
+
+        # Cycles still inside ftplib stop at the next file once stop_event is set
+        await asyncio.get_running_loop().shutdown_default_executor()
+        close_ftp_pools()
+        close_post_processor()
+        self.stop_metrics_server()
         log_message(f"Switch FTP Sync data sync service has been stopped.")
 
-
-    def toggle_auto_start(self):
-        current_auto_start = config.getboolean('Settings', 'auto_start')
-        new_auto_start = not current_auto_start
-        config.set('Settings', 'auto_start', str(new_auto_start))
-        with open(config_path, 'w') as configfile:
-            config.write(configfile)
-        self.update_auto_start_action()
-        reload_config()
-
-    def update_auto_start_action(self):
-        auto_start = config.getboolean('Settings', 'auto_start')
-        if auto_start:
-            self.auto_start_action.setText("\u2713 Auto-Start")
-        else:
-            self.auto_start_action.setText("    Auto-Start")
-
-    def configure_config(self):
-        dialog = ConfigDialog()
-        dialog.exec_()
-        dialog.show()
-
-    def show_about_dialog(self):
-        dialog = AboutDialog()
-        dialog.exec_()
-        dialog.show()
-
-    def restart_app(self):
-        QtWidgets.QApplication.quit()
-        QtCore.QProcess.startDetached(sys.executable, sys.argv)
-
-    def exit_app(self):
-        global running
-        if running:
-            running = False
-            stop_event.set()
-
-        if os.path.exists(temp_download_dir):
-            shutil.rmtree(temp_download_dir)
-        
-        QtWidgets.qApp.quit()
-
-def main():
-    app = QtWidgets.QApplication(sys.argv)
-
-    def is_dark_mode():
-        if sys.platform == 'darwin':
-            import subprocess
-            result = subprocess.run(
-                ["defaults", "read", "-g", "AppleInterfaceStyle"],
-                capture_output=True,
-                text=True,
-            )
-            return "Dark" in result.stdout
-        elif sys.platform == 'win32':
-            import winreg
+    async def run_job(self, key):
+        import asyncio
+        scheduler = PollScheduler(self.jobs[key].name, self.jobs[key].check_rate)
+        while True:
+            job = self.jobs[key]
+            scheduler.interval = job.check_rate
+            # Looked up every cycle, a reload replaces the pool when the console settings change
+            pool = get_ftp_pool(job.console)
+            start_time = time.time()
+            changes = None
+            try:
+                changes = await self.loop.run_in_executor(None, job.cycle, pool, *job.args)
+            except ftplib.all_errors as e:
+                log_message(f"Error during sync operation: {e}")
+            except Exception:
+                # Anything else is a bug, but it must not end this path's polling for good
+                log_message(f"Error during sync operation of {job.name}:\n{traceback.format_exc()}")
+            log_message(pool.stats())
+            elapsed_time = time.time() - start_time
+            # Changed settings end the wait early
+            wakeup = self.wakeups[key]
             try:
-                registry = winreg.ConnectRegistry(None, winreg.HKEY_CURRENT_USER)
-                key = winreg.OpenKey(registry, r"Software\Microsoft\Windows\CurrentVersion\Themes\Personalize")
-                value, _ = winreg.QueryValueEx(key, "AppsUseLightTheme")
-                return value == 0  # 0 means dark mode, 1 means light mode
-            except Exception as e:
-                log_message(f"Failed to read registry: {e}")
-                return False
+                await asyncio.wait_for(wakeup.wait(), scheduler.next_delay(elapsed_time, changes))
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+
+    async def keepalive(self):
+        import asyncio
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            with ftp_pool_lock:
+                pools = list(ftp_pools.values())
+            for pool in pools:
+                await self.loop.run_in_executor(None, pool.ping_idle)
+
+sync_engine = None
+
+def run_sync_service():
+    global sync_engine
+    sync_engine = SyncEngine()
+    sync_engine.run()
+
+def start_sync():
+    global running
+    if running:
+        log_message("Switch FTP Sync is already running.")
         return False
+    running = True
+    stop_event.clear()
+    threading.Thread(target=run_sync_service, daemon=True).start()
+    return True
+
+def stop_sync():
+    global running
+    if not running:
+        log_message("Switch FTP Sync is not running.")
+        return False
+    running = False
+    stop_event.set()
+    if sync_engine:
+        sync_engine.stop()
+    return True
 
-    # Select the appropriate icon based on the system appearance
-    icon_name = "dark_taskbar.png" if is_dark_mode() else "light_taskbar.png"
-    icon_path = os.path.join(script_dir, icon_name)
-    if os.path.exists(icon_path):
-        tray_icon = SystemTrayApp(QtGui.QIcon(icon_path))
-    else:
-        tray_icon = SystemTrayApp(app.style().standardIcon(QtWidgets.QStyle.SP_ComputerIcon))
-
-    tray_icon.show()
+def sync_once():
+    try:
+        for job in sync_jobs().values():
+            job.cycle(get_ftp_pool(job.console), *job.args)
+    except ftplib.all_errors as e:
+        log_message(f"Error during sync operation: {e}")
+    finally:
+        close_ftp_pools()
+    processor = get_post_processor()
+    if processor:
+        processor.drain()
+        close_post_processor()
+
+def run_headless(once=False):
+    global running
+    if once:
+        sync_once()
+        return
+
+    def handle_signal(signum, frame):
+        stop_sync()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    log_message(f"{TITLE} v{VERSION} syncing headless, press Ctrl+C to stop.")
+    running = True
+    stop_event.clear()
+    run_sync_service()
+
+def restore_snapshot(server_path, snapshot_id=None, target=None):
+    sync_path = next((sync_path for console in consoles for sync_path in console.file_sync_paths
+                      if sync_path.server_path == server_path), None)
+    if sync_path is None:
+        log_message(f"{server_path} is not an enabled File Sync path.")
+        return False
+    store = get_snapshot_store(sync_path.server_path, sync_path.output_path)
+    snapshots = store.snapshots()
+    if not snapshots:
+        log_message(f"No snapshots of {server_path} yet.")
+        return False
+    snapshot_id = snapshot_id or snapshots[-1]
+    if snapshot_id not in snapshots:
+        log_message(f"Unknown snapshot {snapshot_id} of {server_path}.")
+        return False
+    restored, skipped = store.restore(snapshot_id, target or sync_path.output_path)
+    log_message(f"Restored snapshot {snapshot_id} of {server_path}: {restored} files written, {skipped} already matching.")
+    return True
+
+def list_snapshots():
+    for sync_path in [sync_path for console in consoles for sync_path in console.file_sync_paths]:
+        if not sync_path.snapshots:
+            continue
+        print(f"{sync_path.server_path} -> {sync_path.output_path}")
+        store = get_snapshot_store(sync_path.server_path, sync_path.output_path)
+        for snapshot_id in store.snapshots():
+            print(f"  {snapshot_id}  {len(store.load(snapshot_id)['files'])} files")
 
-    sys.exit(app.exec_())
+def main():
+    global NOTIFICATIONS
+    parser = argparse.ArgumentParser(prog="switch_ftp_sync", description="Nintendo Switch FTP data-syncing utility.")
+    parser.add_argument("--headless", action="store_true", help="sync without the system tray GUI")
+    parser.add_argument("--once", action="store_true", help="run a single headless sync cycle and exit")
+    parser.add_argument("--config", help="path to config.ini (default: next to the app)")
+    parser.add_argument("--notify", action="store_true", help="send desktop notifications in headless mode")
+    parser.add_argument("--list-snapshots", action="store_true", help="list the snapshots of File Sync paths and exit")
+    parser.add_argument("--restore", metavar="SERVER_PATH", help="restore a snapshot of a File Sync path and exit")
+    parser.add_argument("--snapshot", help="snapshot to restore (default: the latest)")
+    parser.add_argument("--restore-to", metavar="DIR", help="folder to restore into (default: the path's output_path)")
+    # Qt and the macOS launcher may add arguments of their own
+    args, _ = parser.parse_known_args()
+
+    load_config(args.config)
+
+    if args.list_snapshots:
+        list_snapshots()
+    elif args.restore:
+        sys.exit(0 if restore_snapshot(args.restore, args.snapshot, args.restore_to) else 1)
+    elif args.headless or args.once:
+        NOTIFICATIONS = args.notify
+        run_headless(args.once)
+    else:
+        from switch_ftp_sync_gui import run_gui
+        run_gui()
 
 if __name__ == "__main__":
+    # Post-processing workers of the frozen app start through this same executable
+    import multiprocessing
+    multiprocessing.freeze_support()
+    # Let switch_ftp_sync_gui import this script by name without loading a second copy of it
+    sys.modules.setdefault("switch_ftp_sync", sys.modules[__name__])
     main()
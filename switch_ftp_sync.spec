@@ -15,7 +15,7 @@ a = Analysis(
         ('dark_taskbar.png', '.'),
         ('light_taskbar.png', '.')
     ],
-    hiddenimports=[],
+    hiddenimports=['switch_ftp_sync_gui'],
     hookspath=[],
     runtime_hooks=[],
     excludes=[],
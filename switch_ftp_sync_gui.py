@@ -0,0 +1,303 @@
+import sys
+import os
+import webbrowser
+from PyQt5 import QtWidgets, QtGui, QtCore
+
+import switch_ftp_sync as engine
+
+
+class ConfigDialog(QtWidgets.QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Configure Switch FTP Sync")
+        self.layout = QtWidgets.QFormLayout(self)
+        self.setFixedWidth(480)
+
+        self.config_items = {}
+        self.browse_buttons = {}  # To keep track of browse buttons and their corresponding line edits
+        for section in engine.config.sections():
+            if section != 'DEFAULT':
+                if section != 'FTP':
+                    self.layout.addRow(QtWidgets.QLabel(""))
+                label = QtWidgets.QLabel(f"{section}")
+                font = label.font()
+                font.setBold(True)
+                label.setFont(font)
+                self.layout.addRow(label)
+                self.layout.addRow(QtWidgets.QFrame())
+            for key, value in engine.config.items(section):
+                item_label = key
+                if key.startswith('sync_files') or key == 'sync_screenshots' or key == "auto_start":
+                    continue  # Skip these keys for now
+                line_edit = QtWidgets.QLineEdit(value.strip('"'))
+                line_edit.setAlignment(QtCore.Qt.AlignRight)  # Align text to the right
+                self.config_items[f"{section}.{key}"] = line_edit
+
+                if key.startswith('output_path') or key == 'output_path':
+                    browse_button = QtWidgets.QPushButton('\uD83D\uDCC2')  # Folder icon
+                    self.browse_buttons[browse_button] = line_edit  # Associate browse button with line edit
+                    browse_button.clicked.connect(self.handle_browse_button_clicked)
+                    hbox = QtWidgets.QHBoxLayout()
+                    line_edit.setFixedWidth(240)  # Adjust the width of the input box
+                    hbox.addWidget(line_edit)
+                    hbox.addWidget(browse_button)
+                    checkbox = QtWidgets.QCheckBox()
+                    if key == 'output_path':
+                        checkbox.setChecked(engine.config.getboolean(section, 'sync_screenshots', fallback=False))
+                        self.config_items[f"{section}.sync_screenshots"] = checkbox
+                    else:
+                        sync_key = key.replace('output_path', 'sync_files')
+                        checkbox.setChecked(engine.config.getboolean(section, sync_key, fallback=False))
+                        self.config_items[f"{section}.{sync_key}"] = checkbox
+                    hbox.addWidget(checkbox)
+                    self.layout.addRow(QtWidgets.QLabel(f"  {item_label} "), hbox)
+                else:
+                    line_edit.setFixedWidth(300)  # Adjust the width of the input box
+                    self.layout.addRow(QtWidgets.QLabel(f"  {item_label} "), line_edit)  # Added indent for key name
+
+        self.button_box = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel)
+        self.button_box.accepted.connect(self.update_config)
+        self.button_box.rejected.connect(self.reject)
+        self.layout.addRow(self.button_box)
+
+    def handle_browse_button_clicked(self):
+        sender = self.sender()
+        if sender in self.browse_buttons:
+            line_edit = self.browse_buttons[sender]
+            self.select_output_directory(line_edit)
+
+    def select_output_directory(self, line_edit):
+        dir_path = QtWidgets.QFileDialog.getExistingDirectory(self, "Select Directory")
+        if dir_path:
+            if not dir_path.endswith('/'):
+                dir_path += '/'
+            line_edit.setText(dir_path)
+
+    def update_config(self):
+        try:
+            for item_label, widget in self.config_items.items():
+                section, key = item_label.split('.')
+                if isinstance(widget, QtWidgets.QLineEdit):
+                    engine.config.set(section, key, widget.text())
+                elif isinstance(widget, QtWidgets.QCheckBox):
+                    engine.config.set(section, key, str(widget.isChecked()))
+            with open(engine.config_path, 'w') as configfile:
+                engine.config.write(configfile)
+            QtWidgets.QMessageBox.information(self, "Success", "Configuration updated successfully.")
+            engine.reload_config()
+        except Exception as e:
+            QtWidgets.QMessageBox.critical(self, "Error", f"Failed to update configuration: {e}")
+        self.accept()  # Close the dialog
+
+
+
+
+class AboutDialog(QtWidgets.QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("About Switch FTP Sync")
+        self.layout = QtWidgets.QVBoxLayout(self)
+        self.setFixedSize(360, 250)
+
+        icon_path = os.path.join(engine.script_dir, "icon.png")
+        if os.path.exists(icon_path):
+            icon_label = QtWidgets.QLabel()
+            pixmap = QtGui.QPixmap(icon_path).scaled(80, 80, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+            icon_label.setPixmap(pixmap)
+            icon_label.setAlignment(QtCore.Qt.AlignCenter)
+            self.layout.addWidget(icon_label)
+
+        title_label = QtWidgets.QLabel(f"{engine.TITLE} v{engine.VERSION}")
+        title_label.setAlignment(QtCore.Qt.AlignCenter)
+        font = title_label.font()
+        font.setPointSize(14)
+        font.setBold(True)
+        title_label.setFont(font)
+        self.layout.addWidget(title_label)
+
+        description_label = QtWidgets.QLabel("Nintendo Switch FTP data-syncing utility.")
+        description_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.layout.addWidget(description_label)
+
+        author_label = QtWidgets.QLabel(f"Created by {engine.AUTHOR}")
+        author_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.layout.addWidget(author_label)
+
+        github_button = QtWidgets.QPushButton("View on GitHub")
+        github_button.setFixedWidth(120)  # Set fixed width for the button
+        github_button.clicked.connect(lambda: webbrowser.open("https://github.com/ppkantorski/Switch-FTP-Sync"))
+
+        check_updates_button = QtWidgets.QPushButton("Check for Updates")
+        check_updates_button.setFixedWidth(140)  # Set fixed width for the button
+        check_updates_button.clicked.connect(self.check_for_updates)
+
+        ok_button = QtWidgets.QPushButton("OK")
+        ok_button.setFixedWidth(60)  # Set fixed width for the button
+        ok_button.clicked.connect(self.accept)
+
+        # Create a horizontal layout for the buttons
+        button_layout = QtWidgets.QHBoxLayout()
+        button_layout.addWidget(github_button)
+        button_layout.addWidget(check_updates_button)
+        button_layout.addWidget(ok_button)
+
+        # Add the horizontal layout to the main layout
+        self.layout.addLayout(button_layout)
+
+        self.layout.setAlignment(github_button, QtCore.Qt.AlignCenter)
+        self.layout.setAlignment(check_updates_button, QtCore.Qt.AlignCenter)
+        self.layout.setAlignment(ok_button, QtCore.Qt.AlignCenter)
+
+    def check_for_updates(self):
+        import requests
+        try:
+            response = requests.get("https://api.github.com/repos/ppkantorski/Switch-FTP-Sync/releases/latest")
+            response.raise_for_status()  # Raise an exception for HTTP errors
+            latest_release = response.json()
+            latest_version = latest_release["tag_name"].replace("v", "")
+    
+            # Split versions into parts and compare each part
+            latest_version_parts = [int(part) for part in latest_version.split('.')]
+            current_version_parts = [int(part) for part in engine.VERSION.split('.')]
+    
+            if latest_version_parts > current_version_parts:
+                QtWidgets.QMessageBox.information(self, "Update Available", 
+                                                  f"\nA new version v{latest_version} is available.\nYou are currently using v{engine.VERSION}.")
+            else:
+                QtWidgets.QMessageBox.information(self, "Up to Date", 
+                                                  "\nYou are using the latest version.")
+        except requests.RequestException as e:
+            QtWidgets.QMessageBox.critical(self, "Error", f"\nFailed to check for updates: {e}")
+        except ValueError as e:
+            QtWidgets.QMessageBox.critical(self, "Error", f"\nFailed to parse version information: {e}")
+    
+
+
+
+class SystemTrayApp(QtWidgets.QSystemTrayIcon):
+    def __init__(self, icon, parent=None):
+        super(SystemTrayApp, self).__init__(icon, parent)
+        self.setToolTip(f"{engine.TITLE} v{engine.VERSION}")
+        self.parent = parent
+        self.menu = QtWidgets.QMenu(parent)
+
+        self.start_action = self.menu.addAction("\u25B6 Start Data Sync")
+        self.auto_start_action = self.menu.addAction("    Auto-Start")
+        self.menu.addSeparator()
+        self.config_action = self.menu.addAction("    Configure...")
+        self.menu.addSeparator()
+        self.about_action = self.menu.addAction("    About Switch FTP Sync    ")
+        self.menu.addSeparator()
+        self.restart_action = self.menu.addAction("    Restart")  # Add Restart action
+        self.exit_action = self.menu.addAction("    Quit")
+
+        self.start_action.triggered.connect(self.toggle_capture)
+        self.auto_start_action.triggered.connect(self.toggle_auto_start)
+        self.config_action.triggered.connect(self.configure_config)
+        self.about_action.triggered.connect(self.show_about_dialog)
+        self.restart_action.triggered.connect(self.restart_app)  # Connect Restart action to method
+        self.exit_action.triggered.connect(self.exit_app)
+
+        self.setContextMenu(self.menu)
+        self.update_auto_start_action()
+
+        # Show the latest cycle stats when hovering over the tray icon
+        self.tooltip_timer = QtCore.QTimer(self)
+        self.tooltip_timer.timeout.connect(self.update_tooltip)
+        self.tooltip_timer.start(5000)
+
+        if engine.AUTO_START:
+            self.start_capture()
+
+    def toggle_capture(self):
+        if engine.running:
+            self.stop_capture()
+        else:
+            self.start_capture()
+
+    def start_capture(self):
+        if engine.start_sync():
+            self.start_action.setText("\u25A0 Stop Data Sync")
+
+    def stop_capture(self):
+        if engine.stop_sync():
+            self.start_action.setText("\u25B6 Start Data Sync")
+
+    def update_tooltip(self):
+        summary = engine.metrics.summary()
+        tooltip = f"{engine.TITLE} v{engine.VERSION}"
+        if summary:
+            tooltip += f"\n{summary}"
+        self.setToolTip(tooltip)
+
+    def toggle_auto_start(self):
+        current_auto_start = engine.config.getboolean('Settings', 'auto_start')
+        new_auto_start = not current_auto_start
+        engine.config.set('Settings', 'auto_start', str(new_auto_start))
+        with open(engine.config_path, 'w') as configfile:
+            engine.config.write(configfile)
+        self.update_auto_start_action()
+        engine.reload_config()
+
+    def update_auto_start_action(self):
+        auto_start = engine.config.getboolean('Settings', 'auto_start')
+        if auto_start:
+            self.auto_start_action.setText("\u2713 Auto-Start")
+        else:
+            self.auto_start_action.setText("    Auto-Start")
+
+    def configure_config(self):
+        dialog = ConfigDialog()
+        dialog.exec_()
+        dialog.show()
+
+    def show_about_dialog(self):
+        dialog = AboutDialog()
+        dialog.exec_()
+        dialog.show()
+
+    def restart_app(self):
+        QtWidgets.QApplication.quit()
+        QtCore.QProcess.startDetached(sys.executable, sys.argv)
+
+    def exit_app(self):
+        if engine.running:
+            engine.stop_sync()
+
+        QtWidgets.qApp.quit()
+
+def run_gui():
+    app = QtWidgets.QApplication(sys.argv)
+
+    def is_dark_mode():
+        if sys.platform == 'darwin':
+            import subprocess
+            result = subprocess.run(
+                ["defaults", "read", "-g", "AppleInterfaceStyle"],
+                capture_output=True,
+                text=True,
+            )
+            return "Dark" in result.stdout
+        elif sys.platform == 'win32':
+            import winreg
+            try:
+                registry = winreg.ConnectRegistry(None, winreg.HKEY_CURRENT_USER)
+                key = winreg.OpenKey(registry, r"Software\Microsoft\Windows\CurrentVersion\Themes\Personalize")
+                value, _ = winreg.QueryValueEx(key, "AppsUseLightTheme")
+                return value == 0  # 0 means dark mode, 1 means light mode
+            except Exception as e:
+                engine.log_message(f"Failed to read registry: {e}")
+                return False
+        return False
+
+    # Select the appropriate icon based on the system appearance
+    icon_name = "dark_taskbar.png" if is_dark_mode() else "light_taskbar.png"
+    icon_path = os.path.join(engine.script_dir, icon_name)
+    if os.path.exists(icon_path):
+        tray_icon = SystemTrayApp(QtGui.QIcon(icon_path))
+    else:
+        tray_icon = SystemTrayApp(app.style().standardIcon(QtWidgets.QStyle.SP_ComputerIcon))
+
+    tray_icon.show()
+
+    sys.exit(app.exec_())